@@ -0,0 +1,167 @@
+"""
+计算器核心的微基准测试
+测量分词、解析、求值、编译缓存命中/未命中以及按键状态机的吞吐量
+
+    python -m benchmarks.bench_calculator                    # 运行并打印
+    python -m benchmarks.bench_calculator -o results.json    # 保存结果
+    python -m benchmarks.bench_calculator --baseline benchmarks/baseline.json
+                                                             # 与基线比较，退化超过阈值时返回 1
+    python -m benchmarks.bench_calculator --update-baseline  # 把本次结果写为基线
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from benchmarks import corpora
+from calculator import engine
+from calculator.state import CalculatorState
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# 单次计时至少持续这么久，减少计时误差
+MIN_DURATION = 0.2
+REPEAT = 5
+THRESHOLD = 0.25
+
+
+def measure(func, items, repeat=REPEAT):
+    """对 items 中每一项调用 func，返回每次操作的最短平均耗时（纳秒）"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in items:
+                func(item)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_DURATION:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in items:
+                func(item)
+        best = min(best, time.perf_counter() - start)
+
+    return best / (loops * len(items)) * 1e9
+
+
+def compile_uncached(text):
+    """每次都重新分词和解析（相当于缓存未命中）"""
+    engine.clear_cache()
+    return engine.compile_expression(text)
+
+
+def press_all(keys):
+    state = CalculatorState()
+    press = state.press
+    for key in keys:
+        press(key)
+
+
+def run_benchmarks():
+    """运行全部基准，返回 {名称: 每次操作纳秒数}"""
+    results = {}
+
+    for name, make_corpus in corpora.CORPORA.items():
+        expressions = make_corpus()
+        tokens = [engine.tokenize(text) for text in expressions]
+        compiled = [engine.compile_expression(text) for text in expressions]
+
+        results[f'tokenize/{name}'] = measure(engine.tokenize, expressions)
+        results[f'parse/{name}'] = measure(engine.parse, tokens)
+        results[f'evaluate/{name}'] = measure(lambda c: c.evaluate(), compiled)
+        results[f'cache_miss/{name}'] = measure(compile_uncached, expressions)
+
+        # 语料比缓存小，预热后全部命中
+        cached = expressions[:engine.CACHE_SIZE]
+        for text in cached:
+            engine.compile_expression(text)
+        results[f'cache_hit/{name}'] = measure(engine.compile_expression, cached)
+
+    sequences = corpora.keypresses()
+    key_count = sum(len(keys) for keys in sequences)
+    per_sequence = measure(press_all, sequences)
+    results['keypress'] = per_sequence * len(sequences) / key_count
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """返回退化超过阈值的 [(名称, 基线, 本次, 变化比例)]"""
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        change = value / base - 1
+        if change > threshold:
+            regressions.append((name, base, value, change))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'基准':<22}{'ns/次':>12}{'次/秒':>14}{'对比基线':>12}")
+    print("-" * 60)
+    for name, value in results.items():
+        line = f"{name:<22}{value:>12.0f}{1e9 / value:>14.0f}"
+        if baseline and baseline.get(name):
+            line += f"{(value / baseline[name] - 1) * 100:>+11.1f}%"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.bench_calculator',
+        description='计算器核心微基准测试'
+    )
+    parser.add_argument('-o', '--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', help='与基线 JSON 比较')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help=f'允许的退化比例（默认 {THRESHOLD}）')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help=f'把结果写入 {BASELINE_PATH}')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    print_results(results, baseline)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'unit': 'ns/op',
+        'results': results,
+    }
+    for path in filter(None, (args.output,
+                              BASELINE_PATH if args.update_baseline else None)):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 已保存: {path}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ 性能退化超过 {args.threshold:.0%}:")
+            for name, base, value, change in regressions:
+                print(f"   {name}: {base:.0f} -> {value:.0f} ns ({change:+.1%})")
+            return 1
+        print(f"\n✅ 没有超过 {args.threshold:.0%} 的退化")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+基准测试用的固定表达式语料
+用固定的随机种子生成，每次运行结果完全相同
+"""
+
+import random
+
+
+SEED = 20240601
+OPERATORS = '+-*/'
+
+
+def _operand(rng):
+    if rng.random() < 0.3:
+        return f"{rng.randint(0, 999)}.{rng.randint(0, 99)}"
+    # 避免 0，防止除零让计算提前结束
+    return str(rng.randint(1, 9999))
+
+
+def _chain(rng, operands):
+    parts = []
+    for i in range(operands):
+        if i:
+            parts.append(rng.choice(OPERATORS))
+        parts.append(_operand(rng))
+    return ''.join(parts)
+
+
+def _precedence_chain(rng, terms):
+    """加减连接的乘除项，每个乘除项的操作数前带一元负号，例如 a-b*-c/d+-e*f"""
+    parts = []
+    for i in range(terms):
+        if i:
+            parts.append(rng.choice('+-'))
+        for j in range(rng.randint(2, 4)):
+            if j:
+                parts.append(rng.choice('*/'))
+            parts.append('-' + _operand(rng))
+    return ''.join(parts)
+
+
+def short(count=1000):
+    """短表达式：两三个操作数"""
+    rng = random.Random(SEED)
+    return [_chain(rng, rng.randint(2, 3)) for _ in range(count)]
+
+
+def long(count=100):
+    """长表达式：200 个操作数"""
+    rng = random.Random(SEED + 1)
+    return [_chain(rng, 200) for _ in range(count)]
+
+
+def nested(count=200):
+    """优先级交替：加减和乘除交替出现，每个操作数前有一元负号
+
+    文法没有括号，解析器的递归深度最多三层（加减、乘除、一元符号），
+    这里让每个操作数都经过完整的三层下降和返回
+    """
+    rng = random.Random(SEED + 2)
+    return [_precedence_chain(rng, 30) for _ in range(count)]
+
+
+def keypresses(count=200):
+    """按键序列：表达式按键后按 =，覆盖运算符替换和结果续算"""
+    rng = random.Random(SEED + 3)
+    sequences = []
+    for _ in range(count):
+        keys = []
+        for _ in range(rng.randint(2, 6)):
+            keys.extend(_chain(rng, 2))
+            if rng.random() < 0.2:
+                keys.append(rng.choice(OPERATORS))
+            keys.append(rng.choice(OPERATORS))
+        keys.append('=')
+        keys.append('C')
+        sequences.append(keys)
+    return sequences
+
+
+CORPORA = {
+    'short': short,
+    'long': long,
+    'nested': nested,
+}
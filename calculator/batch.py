@@ -0,0 +1,147 @@
+"""
+批量计算
+从文件或标准输入逐行读取表达式，逐行输出结果
+
+用法: python -m calculator.batch [输入文件] [-o 输出文件] [--workers N]
+                                 [--mode float|decimal|fraction]
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from calculator.engine import BACKENDS, calculate, get_backend, normalize
+
+
+CHUNK_SIZE = 4096
+# 一批中需要新计算的表达式达到这个数量时才使用进程池
+POOL_THRESHOLD = 2048
+# 结果缓存上限，超过后清空，避免超大输入占满内存
+MEMO_SIZE = 200000
+
+
+def _calculate_all(expressions, mode='float', precision=None):
+    """在工作进程中计算一组表达式"""
+    backend = get_backend(mode, precision)
+    return [calculate(expression, backend) for expression in expressions]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _split(items, parts):
+    """把列表平均分成若干份"""
+    step = -(-len(items) // parts)
+    return [items[i:i + step] for i in range(0, len(items), step)]
+
+
+def evaluate_many(expressions, workers=None, chunk_size=CHUNK_SIZE,
+                  pool_threshold=POOL_THRESHOLD, stats=None,
+                  mode='float', precision=None):
+    """逐个产出 (表达式, 结果)
+
+    相同的表达式只计算一次；输入量大时用进程池并行计算。
+    stats 字典（可选）会记录表达式总数和去重后的数量。
+    mode / precision 选择数值后端，见 engine.get_backend()。
+    """
+    workers = workers or os.cpu_count() or 1
+    backend = get_backend(mode, precision)
+    results = {}
+    pool = None
+
+    if stats is not None:
+        stats.setdefault('expressions', 0)
+        stats.setdefault('distinct', 0)
+
+    try:
+        for chunk in _chunks(expressions, chunk_size):
+            if len(results) > MEMO_SIZE:
+                results.clear()
+
+            keys = [normalize(expression) for expression in chunk]
+            missing = [key for key in dict.fromkeys(keys) if key not in results]
+
+            if workers > 1 and len(missing) >= pool_threshold:
+                if pool is None:
+                    pool = ProcessPoolExecutor(workers)
+                parts = _split(missing, workers)
+                values_list = pool.map(_calculate_all, parts,
+                                       itertools.repeat(mode),
+                                       itertools.repeat(precision))
+                for part, values in zip(parts, values_list):
+                    results.update(zip(part, values))
+            else:
+                for key in missing:
+                    results[key] = calculate(key, backend)
+
+            if stats is not None:
+                stats['expressions'] += len(chunk)
+                stats['distinct'] += len(missing)
+
+            for expression, key in zip(chunk, keys):
+                yield expression, results[key]
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m calculator.batch',
+        description='批量计算表达式，每行一个'
+    )
+    parser.add_argument('input', nargs='?', help='输入文件（默认标准输入）')
+    parser.add_argument('-o', '--output', help='输出文件（默认标准输出）')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='进程数（默认 CPU 核数，1 表示不用进程池）')
+    parser.add_argument('-m', '--mode', choices=BACKENDS, default='float',
+                        help='数值后端（默认 float）')
+    parser.add_argument('-p', '--precision', type=int, default=None,
+                        help='decimal 模式的有效位数（默认 28）')
+    parser.add_argument('-e', '--echo', action='store_true',
+                        help='输出 "表达式<TAB>结果"')
+    args = parser.parse_args(argv)
+
+    source = open(args.input, encoding='utf-8') if args.input else sys.stdin
+    target = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    stats = {}
+    start = time.perf_counter()
+
+    try:
+        lines = (line.rstrip('\r\n') for line in source)
+        for expression, result in evaluate_many(lines, args.workers, stats=stats,
+                                                mode=args.mode,
+                                                precision=args.precision):
+            if args.echo:
+                target.write(f"{expression}\t{result}\n")
+            else:
+                target.write(f"{result}\n")
+    finally:
+        if args.input:
+            source.close()
+        if args.output:
+            target.close()
+
+    elapsed = time.perf_counter() - start
+    rate = stats['expressions'] / elapsed if elapsed > 0 else 0
+    print(f"📊 表达式: {stats['expressions']} | "
+          f"去重后: {stats['distinct']} | "
+          f"用时: {elapsed:.2f} 秒 | "
+          f"吞吐: {rate:.0f} 条/秒", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
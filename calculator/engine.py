@@ -0,0 +1,588 @@
+"""
+计算器表达式引擎
+只支持数字、小数点、变量名和 + - * / 四则运算，用来替代 eval()
+表达式编译为后缀指令序列，并按规范化后的字符串做 LRU 缓存
+数值后端可选 float（默认）、decimal 和 fraction
+"""
+
+import functools
+import operator
+
+
+ERROR = 'Error'
+OPERATORS = ('+', '-', '*', '/')
+DIGITS = '0123456789'
+
+# 后缀指令
+PUSH = 'push'
+LOAD = 'load'
+NEG = 'neg'
+
+# 二元运算符的绑定强度（Pratt 解析）
+BINDING_POWER = {'+': 10, '-': 10, '*': 20, '/': 20}
+# 一元正负号比乘除绑定更紧：-2*3 == (-2)*3，2*-3 == 2*(-3)
+PREFIX_POWER = 30
+
+BINARY = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+CACHE_SIZE = 512
+# 精确后端（decimal / fraction）的数字位数上限，与 Python 整数和字符串转换的默认上限一致
+MAX_DIGITS = 4300
+
+
+class ExpressionError(ValueError):
+    """表达式无法解析"""
+
+
+def normalize(text):
+    """规范化表达式，作为缓存键
+
+    去掉运算符两侧的空白；两个操作数之间的空白保留一个空格，
+    否则 '5 5' 会被拼成 55，而它本应是缺少运算符的错误表达式
+    """
+    parts = text.split()
+    if not parts:
+        return ''
+    pieces = [parts[0]]
+    for part in parts[1:]:
+        if pieces[-1][-1] not in OPERATORS and part[0] not in OPERATORS:
+            pieces.append(' ')
+        pieces.append(part)
+    return ''.join(pieces)
+
+
+def tokenize(text):
+    """把表达式切分为 (类型, 文本) 记号列表"""
+    tokens = []
+    i = 0
+    length = len(text)
+
+    while i < length:
+        ch = text[i]
+
+        if ch.isspace():
+            i += 1
+        elif ch in OPERATORS:
+            tokens.append(('op', ch))
+            i += 1
+        elif ch in DIGITS or ch == '.':
+            end = _scan_number(text, i)
+            tokens.append(('num', text[i:end]))
+            i = end
+        elif ch.isalpha() or ch == '_':
+            end = i + 1
+            while end < length and (text[end].isalnum() or text[end] == '_'):
+                end += 1
+            tokens.append(('name', text[i:end]))
+            i = end
+        else:
+            raise ExpressionError(f"无法识别的字符: {ch!r}")
+
+    return tokens
+
+
+def _scan_number(text, start):
+    """扫描一个数字字面量，返回结束位置"""
+    i = start
+    length = len(text)
+    digits = 0
+
+    while i < length and text[i] in DIGITS:
+        i += 1
+        digits += 1
+
+    if i < length and text[i] == '.':
+        i += 1
+        while i < length and text[i] in DIGITS:
+            i += 1
+            digits += 1
+
+    if digits == 0:
+        raise ExpressionError("小数点前后缺少数字")
+
+    # 指数部分（结果回填到显示屏时可能出现 1e-05 这样的写法）
+    if i < length and text[i] in 'eE':
+        j = i + 1
+        if j < length and text[j] in '+-':
+            j += 1
+        if j < length and text[j] in DIGITS:
+            while j < length and text[j] in DIGITS:
+                j += 1
+            i = j
+
+    if i < length and text[i] == '.':
+        raise ExpressionError("数字中有多个小数点")
+
+    return i
+
+
+def is_integer_literal(text):
+    """数字字面量是否为整数写法"""
+    return not ('.' in text or 'e' in text or 'E' in text)
+
+
+def check_exponent(text):
+    """精确后端会把指数展开成完整的数字，指数超过 MAX_DIGITS 时报错"""
+    index = max(text.find('e'), text.find('E'))
+    if index < 0:
+        return
+    exponent = text[index + 1:].lstrip('+-').lstrip('0')
+    # 先比较长度，避免把很长的指数转换成整数
+    if len(exponent) > len(str(MAX_DIGITS)) or (exponent and int(exponent) > MAX_DIGITS):
+        raise ExpressionError(f"指数太大: {text!r}")
+
+
+def parse_number(text):
+    """把数字字面量转换为 int 或 float"""
+    if is_integer_literal(text):
+        return int(text)
+    return float(text)
+
+
+class FloatBackend:
+    """默认后端：与 Python 的 int / float 运算一致"""
+
+    name = 'float'
+
+    def __init__(self):
+        self.binary = BINARY
+        self.neg = operator.neg
+
+    def number(self, text):
+        return parse_number(text)
+
+    def format(self, value):
+        return str(value)
+
+
+class DecimalBackend:
+    """十进制后端：操作数都是整数时保持 int，需要时才转为 Decimal
+
+    precision 只作用于 Decimal 运算（整数加减乘总是精确的）
+    """
+
+    name = 'decimal'
+
+    def __init__(self, precision=28):
+        # decimal / fractions 只在选用对应后端时才导入，缩短应用冷启动
+        import decimal
+
+        self.Decimal = decimal.Decimal
+        self.context = decimal.Context(prec=precision)
+        self.binary = {
+            '+': self.add,
+            '-': self.sub,
+            '*': self.mul,
+            '/': self.div,
+        }
+
+    def number(self, text):
+        if is_integer_literal(text):
+            return int(text)
+        check_exponent(text)
+        return self.Decimal(text)
+
+    def add(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a + b
+        return self.context.add(a, b)
+
+    def sub(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a - b
+        return self.context.subtract(a, b)
+
+    def mul(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a * b
+        return self.context.multiply(a, b)
+
+    def div(self, a, b):
+        if type(a) is int and type(b) is int:
+            quotient, remainder = divmod(a, b)
+            if not remainder:
+                return quotient
+        return self.context.divide(a, b)
+
+    def neg(self, a):
+        if type(a) is int:
+            return -a
+        # 取反是精确的，不按精度舍入
+        return a.copy_negate()
+
+    def format(self, value):
+        if type(value) is int:
+            return str(value)
+        value = value.normalize(self.context)
+        if value.is_finite() and abs(value.adjusted()) > MAX_DIGITS:
+            # 展开后太长，改用科学计数法
+            return str(value)
+        # 去掉末尾的 0，并且不用科学计数法
+        return format(value, 'f')
+
+
+class FractionBackend:
+    """分数后端：操作数都是整数时保持 int，除不尽时才转为 Fraction"""
+
+    name = 'fraction'
+
+    def __init__(self):
+        import fractions
+
+        self.Fraction = fractions.Fraction
+        self.binary = {
+            '+': self.add,
+            '-': self.sub,
+            '*': self.mul,
+            '/': self.div,
+        }
+
+    def number(self, text):
+        if is_integer_literal(text):
+            return int(text)
+        check_exponent(text)
+        return self.demote(self.Fraction(text))
+
+    def demote(self, value):
+        """分母为 1 的分数退回 int"""
+        if value.denominator == 1:
+            return value.numerator
+        return value
+
+    def add(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a + b
+        return self.demote(a + b)
+
+    def sub(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a - b
+        return self.demote(a - b)
+
+    def mul(self, a, b):
+        if type(a) is int and type(b) is int:
+            return a * b
+        return self.demote(a * b)
+
+    def div(self, a, b):
+        if type(a) is int and type(b) is int:
+            quotient, remainder = divmod(a, b)
+            if not remainder:
+                return quotient
+            return self.Fraction(a, b)
+        return self.demote(a / b)
+
+    def neg(self, a):
+        return -a
+
+    def format(self, value):
+        return str(value)
+
+
+FLOAT = FloatBackend()
+BACKENDS = ('float', 'decimal', 'fraction')
+
+
+def get_backend(mode='float', precision=None):
+    """按名称创建数值后端"""
+    if mode == 'float':
+        return FLOAT
+    if mode == 'decimal':
+        return DecimalBackend(precision or 28)
+    if mode == 'fraction':
+        return FractionBackend()
+    raise ValueError(f"未知的数值后端: {mode!r}")
+
+
+class _Parser:
+    """Pratt 解析器，直接输出后缀指令"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.program = []
+
+    def parse(self):
+        if not self.tokens:
+            raise ExpressionError("表达式为空")
+
+        self.expression(0)
+
+        if self.pos != len(self.tokens):
+            raise ExpressionError(f"多余的记号: {self.tokens[self.pos][1]!r}")
+
+        return tuple(self.program)
+
+    def next_token(self):
+        if self.pos >= len(self.tokens):
+            raise ExpressionError("表达式不完整")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expression(self, min_power):
+        kind, text = self.next_token()
+
+        if kind == 'num':
+            # 常量保留原文，由数值后端在 bind() 时转换
+            self.program.append((PUSH, text))
+        elif kind == 'name':
+            self.program.append((LOAD, text))
+        elif text in ('+', '-'):
+            # 连续的正负号合并为一个（不逐个递归，很长的 ---...1 也不会超出递归深度）
+            negative = text == '-'
+            while self.pos < len(self.tokens) and self.tokens[self.pos] in (('op', '+'), ('op', '-')):
+                negative ^= self.tokens[self.pos][1] == '-'
+                self.pos += 1
+            self.expression(PREFIX_POWER)
+            if negative:
+                self.program.append((NEG, None))
+        else:
+            raise ExpressionError(f"运算符位置错误: {text!r}")
+
+        while self.pos < len(self.tokens):
+            kind, text = self.tokens[self.pos]
+            if kind != 'op':
+                raise ExpressionError(f"缺少运算符: {text!r}")
+            power = BINDING_POWER[text]
+            # 左结合：同级运算符交给外层处理
+            if power <= min_power:
+                break
+            self.pos += 1
+            self.expression(power)
+            self.program.append((text, None))
+
+
+def parse(tokens):
+    """把记号列表解析为后缀指令元组"""
+    return _Parser(tokens).parse()
+
+
+def run(program, env=None, backend=FLOAT):
+    """执行（已绑定后端的）后缀指令，env 提供变量的值"""
+    binary = backend.binary
+    neg = backend.neg
+    stack = []
+    push = stack.append
+    pop = stack.pop
+
+    for op, arg in program:
+        if op is PUSH:
+            push(arg)
+        elif op is LOAD:
+            if env is None or arg not in env:
+                raise ExpressionError(f"未定义的变量: {arg!r}")
+            push(env[arg])
+        elif op is NEG:
+            stack[-1] = neg(stack[-1])
+        else:
+            right = pop()
+            stack[-1] = binary[op](stack[-1], right)
+
+    return stack[0]
+
+
+class CompiledExpression:
+    """编译后的表达式"""
+
+    __slots__ = ('source', 'program', 'variables', 'bound')
+
+    def __init__(self, source, program):
+        self.source = source
+        self.program = program
+        # 按首次出现顺序排列的变量名
+        self.variables = tuple(dict.fromkeys(
+            arg for op, arg in program if op is LOAD
+        ))
+        # {后端名称: 常量已转换的指令}
+        self.bound = {}
+
+    def bind(self, backend=FLOAT):
+        """返回常量已按后端转换的指令（每个后端只转换一次）"""
+        program = self.bound.get(backend.name)
+        if program is None:
+            number = backend.number
+            program = tuple(
+                (op, number(arg)) if op is PUSH else (op, arg)
+                for op, arg in self.program
+            )
+            self.bound[backend.name] = program
+        return program
+
+    def evaluate(self, env=None, backend=FLOAT):
+        """计算结果（除零时抛出 ZeroDivisionError）"""
+        return run(self.bind(backend), env, backend)
+
+    def __repr__(self):
+        return f"CompiledExpression({self.source!r})"
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile(source):
+    return CompiledExpression(source, parse(tokenize(source)))
+
+
+def compile_expression(text):
+    """编译表达式（按规范化字符串缓存）"""
+    return _compile(normalize(text))
+
+
+def cache_info():
+    """编译缓存的命中统计"""
+    return _compile.cache_info()
+
+
+def clear_cache():
+    """清空编译缓存"""
+    _compile.cache_clear()
+
+
+def evaluate(text, env=None, backend=FLOAT):
+    """计算表达式的数值"""
+    return compile_expression(text).evaluate(env, backend)
+
+
+def format_result(value, backend=FLOAT):
+    """把结果转换为显示文本"""
+    return backend.format(value)
+
+
+def calculate(text, backend=FLOAT):
+    """计算表达式并返回显示文本，出错时返回 'Error'"""
+    try:
+        return backend.format(evaluate(text, backend=backend))
+    except (ValueError, ArithmeticError, RecursionError):
+        # ValueError 包括 ExpressionError，以及超过整数与字符串转换的位数上限（Python 3.11+ 默认 4300 位）
+        return ERROR
+
+
+class IncrementalEvaluator:
+    """边输入边计算
+
+    每次按键只更新部分解析状态（已完成的加法项、当前乘除项、
+    待定运算符和正在输入的数字），不必重新解析整个表达式。
+    运算符在下一个数字开始时才生效，所以可以被直接替换。
+    计算顺序与 run() 完全相同，结果和 calculate() 一致。
+    """
+
+    __slots__ = ('backend', 'total', 'add_op', 'term', 'negative',
+                 'mul_op', 'pending', 'number', 'error')
+
+    def __init__(self, backend=FLOAT):
+        self.backend = backend
+        self.reset()
+
+    def reset(self):
+        """清空状态"""
+        self.total = None      # 已完成的加法项之和
+        self.add_op = None     # total 与当前项之间的 + 或 -
+        self.term = None       # 当前乘除项
+        self.negative = False  # 表达式开头的负号（只作用于第一个数字）
+        self.mul_op = None     # 当前数字与 term 之间的 * 或 /
+        self.pending = None    # 还没生效的运算符
+        self.number = ''       # 正在输入的数字
+        self.error = False
+
+    def load(self, text):
+        """从一个结果文本继续输入"""
+        self.reset()
+        if '/' in text:
+            # 分数结果（如 -1/3）按表达式重新输入
+            for key in text:
+                self.feed(key)
+        else:
+            self.number = text
+
+    def feed(self, key):
+        """输入一个字符（数字、小数点或运算符）"""
+        if self.error:
+            return
+
+        if key in OPERATORS:
+            self.feed_operator(key)
+            return
+
+        if not self.number and self.pending is not None:
+            self.apply_pending()
+        self.number += key
+
+    def feed_operator(self, key):
+        if self.number:
+            try:
+                self.term = self.combine(self.term, self.number)
+            except (ValueError, ArithmeticError):
+                self.error = True
+            self.number = ''
+        elif self.term is None and self.total is None and key in '*/':
+            # 乘除号前面没有数字
+            self.error = True
+        self.pending = key
+
+    def apply_pending(self):
+        """下一个数字开始时让待定运算符生效"""
+        op = self.pending
+        self.pending = None
+
+        if op in ('*', '/'):
+            self.mul_op = op
+            return
+
+        if self.term is None and self.total is None:
+            # 表达式开头的正负号
+            self.negative = op == '-'
+            return
+
+        if self.term is not None:
+            try:
+                self.total = self.fold(self.term)
+            except ArithmeticError:
+                self.error = True
+        self.term = None
+        self.add_op = op
+        self.mul_op = None
+
+    def fold(self, term):
+        """把一个乘除项加到 total 上"""
+        if self.total is None:
+            return term
+        return self.backend.binary[self.add_op](self.total, term)
+
+    def combine(self, term, number):
+        backend = self.backend
+        value = backend.number(number)
+        if term is None:
+            if self.negative and self.total is None:
+                return backend.neg(value)
+            return value
+        return backend.binary[self.mul_op](term, value)
+
+    def value(self):
+        """当前表达式的值，无法计算时返回 None"""
+        if self.error:
+            return None
+
+        current = self.term
+        try:
+            if self.number:
+                current = self.combine(current, self.number)
+            if current is None:
+                return self.total
+            return self.fold(current)
+        except (ValueError, ArithmeticError):
+            return None
+
+    def preview(self):
+        """预览文本，无法计算时为空"""
+        value = self.value()
+        if value is None:
+            return ''
+        try:
+            return self.backend.format(value)
+        except ValueError:
+            # 结果的位数超过整数转字符串的上限
+            return ''
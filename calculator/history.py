@@ -0,0 +1,306 @@
+"""
+计算历史
+只追加的二进制日志 + 定长偏移索引，读取时用 mmap，不把整个文件读进内存
+
+    <目录>/history.dat   记录: <时间戳 f64><表达式长度 u16><结果长度 u16><表达式><结果>
+    <目录>/history.idx   每条记录在 history.dat 中的偏移: <u64>
+
+    <目录>/history.pfx   结果前缀索引: <结果的前 16 字节，不足补 0><记录序号 u64>，按字节排序
+
+第 i 条记录的偏移在 history.idx 的 i * 8 处，所以取最近 N 条只需读 N 个索引项。
+前缀索引用大端序，排序后的字节顺序就是 (结果前缀, 序号) 的顺序，按前缀查找时二分出匹配的范围；
+新记录先不进索引，攒够 MERGE_EVERY 条后按二分找到的位置整块合并进新文件再替换，
+查找时只需线性检查这部分新记录。
+"""
+
+import collections
+import heapq
+import mmap
+import os
+import struct
+import time
+
+
+RECORD_HEADER = struct.Struct('<dHH')
+INDEX_ENTRY = struct.Struct('<Q')
+MAX_FIELD = 0xFFFF
+# 前缀索引项: (结果的前 PREFIX_SIZE 字节, 记录序号)
+PREFIX_SIZE = 16
+PREFIX_ENTRY = struct.Struct('>16sQ')
+# 没进前缀索引的新记录攒够这么多条时合并
+MERGE_EVERY = 4096
+
+HistoryEntry = collections.namedtuple('HistoryEntry', 'timestamp expression result')
+
+
+class HistoryStore:
+    """计算历史存储"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'history.dat')
+        self.index_path = os.path.join(directory, 'history.idx')
+        self.prefix_path = os.path.join(directory, 'history.pfx')
+
+        self.data_file = open(self.data_path, 'ab+')
+        self.index_file = open(self.index_path, 'ab+')
+
+        self.data_map = None
+        self.index_map = None
+        self.prefix_map = None
+
+        self.recover()
+        self.merge_prefix_index(MERGE_EVERY)
+
+    def recover(self):
+        """丢弃写了一半的记录（例如写入时进程被杀）"""
+        data_size = os.path.getsize(self.data_path)
+        index_size = os.path.getsize(self.index_path)
+        count = index_size // INDEX_ENTRY.size
+
+        # 从后往前找到最后一条完整的记录
+        end = 0
+        with open(self.index_path, 'rb') as index_file, \
+                open(self.data_path, 'rb') as data_file:
+            while count:
+                index_file.seek((count - 1) * INDEX_ENTRY.size)
+                offset, = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+                data_file.seek(offset)
+                header = data_file.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    _, expression_size, result_size = RECORD_HEADER.unpack(header)
+                    end = offset + RECORD_HEADER.size + expression_size + result_size
+                    if end <= data_size:
+                        break
+                end = 0
+                count -= 1
+
+        if index_size != count * INDEX_ENTRY.size:
+            self.index_file.truncate(count * INDEX_ENTRY.size)
+        if data_size != end:
+            self.data_file.truncate(end)
+
+        self.count = count
+        self.data_size = end
+
+        # 前缀索引覆盖的记录数（前 indexed 条）；比记录还多说明数据丢了，重建
+        try:
+            self.indexed = os.path.getsize(self.prefix_path) // PREFIX_ENTRY.size
+        except FileNotFoundError:
+            self.indexed = 0
+        if self.indexed > count:
+            os.remove(self.prefix_path)
+            self.indexed = 0
+
+    def append(self, expression, result, timestamp=None):
+        """追加一条记录"""
+        expression_bytes = expression.encode('utf-8')[:MAX_FIELD]
+        result_bytes = result.encode('utf-8')[:MAX_FIELD]
+        if timestamp is None:
+            timestamp = time.time()
+
+        offset = self.data_size
+        record = RECORD_HEADER.pack(timestamp, len(expression_bytes), len(result_bytes))
+
+        # 先写数据再写索引，索引里出现的偏移总是指向完整的记录
+        self.data_file.write(record + expression_bytes + result_bytes)
+        self.data_file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(offset))
+        self.index_file.flush()
+
+        self.data_size += len(record) + len(expression_bytes) + len(result_bytes)
+        self.count += 1
+        self.merge_prefix_index(MERGE_EVERY)
+
+    def __len__(self):
+        return self.count
+
+    def _maps(self):
+        """返回覆盖当前文件大小的 mmap（文件增长后重新映射）"""
+        index_size = self.count * INDEX_ENTRY.size
+
+        if self.index_map is None or len(self.index_map) < index_size:
+            self._close_maps()
+            self.index_map = mmap.mmap(self.index_file.fileno(), index_size,
+                                       access=mmap.ACCESS_READ)
+            self.data_map = mmap.mmap(self.data_file.fileno(), self.data_size,
+                                      access=mmap.ACCESS_READ)
+
+        return self.index_map, self.data_map
+
+    def _read(self, index_map, data_map, i):
+        offset, = INDEX_ENTRY.unpack_from(index_map, i * INDEX_ENTRY.size)
+        timestamp, expression_size, result_size = RECORD_HEADER.unpack_from(data_map, offset)
+        start = offset + RECORD_HEADER.size
+        middle = start + expression_size
+        return HistoryEntry(
+            timestamp,
+            data_map[start:middle].decode('utf-8', 'replace'),
+            data_map[middle:middle + result_size].decode('utf-8', 'replace'),
+        )
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("历史记录下标越界")
+        index_map, data_map = self._maps()
+        return self._read(index_map, data_map, i)
+
+    def last(self, n):
+        """最近的 n 条记录（从新到旧）"""
+        if not self.count:
+            return []
+        index_map, data_map = self._maps()
+        stop = max(self.count - n, 0)
+        return [self._read(index_map, data_map, i)
+                for i in range(self.count - 1, stop - 1, -1)]
+
+    def _result_startswith(self, index_map, data_map, i, prefix_bytes):
+        """第 i 条记录的结果是否以 prefix_bytes 开头（只比较前缀字节，不解码整条记录）"""
+        offset, = INDEX_ENTRY.unpack_from(index_map, i * INDEX_ENTRY.size)
+        _, expression_size, result_size = RECORD_HEADER.unpack_from(data_map, offset)
+        start = offset + RECORD_HEADER.size + expression_size
+        return result_size >= len(prefix_bytes) and \
+            data_map[start:start + len(prefix_bytes)] == prefix_bytes
+
+    def _prefix_key(self, index_map, data_map, i):
+        offset, = INDEX_ENTRY.unpack_from(index_map, i * INDEX_ENTRY.size)
+        _, expression_size, result_size = RECORD_HEADER.unpack_from(data_map, offset)
+        start = offset + RECORD_HEADER.size + expression_size
+        return data_map[start:start + min(result_size, PREFIX_SIZE)]
+
+    def _prefix_entries(self):
+        """前缀索引的 mmap，索引为空时返回 None"""
+        if self.prefix_map is None and self.indexed:
+            with open(self.prefix_path, 'rb') as prefix_file:
+                self.prefix_map = mmap.mmap(prefix_file.fileno(), self.indexed * PREFIX_ENTRY.size,
+                                            access=mmap.ACCESS_READ)
+        return self.prefix_map
+
+    def _bisect(self, prefix_map, key, right=False, lo=0):
+        """在前缀索引中二分：第一个前 len(key) 字节 >= key（right 时为 > key）的位置"""
+        size = PREFIX_ENTRY.size
+        length = len(key)
+        hi = self.indexed
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = prefix_map[mid * size:mid * size + length]
+            if current < key or (right and current == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def merge_prefix_index(self, threshold=1):
+        """把还没进前缀索引的记录合并进去（至少 threshold 条时）"""
+        pending = self.count - self.indexed
+        if pending < max(threshold, 1):
+            return
+
+        index_map, data_map = self._maps()
+        new_entries = sorted(
+            PREFIX_ENTRY.pack(self._prefix_key(index_map, data_map, i), i)
+            for i in range(self.indexed, self.count)
+        )
+
+        # 旧索引按新项的插入位置整块复制，不逐项读写
+        prefix_map = self._prefix_entries()
+        size = PREFIX_ENTRY.size
+        temp_path = self.prefix_path + '.tmp'
+        with open(temp_path, 'wb') as out:
+            start = 0
+            for entry in new_entries:
+                if prefix_map is not None:
+                    position = self._bisect(prefix_map, entry, lo=start)
+                    out.write(prefix_map[start * size:position * size])
+                    start = position
+                out.write(entry)
+            if prefix_map is not None:
+                out.write(prefix_map[start * size:self.indexed * size])
+
+        # 替换前先解除映射（Windows 上不能替换正在映射的文件）
+        self._close_prefix_map()
+        os.replace(temp_path, self.prefix_path)
+        self.indexed = self.count
+
+    def search(self, prefix, limit=20):
+        """按结果前缀查找（从新到旧，最多 limit 条）
+
+        新记录（最多 MERGE_EVERY 条）逐条比较，其余的在前缀索引中二分出匹配的范围；
+        前缀超过 PREFIX_SIZE 字节时，范围内的记录再逐条核对
+        """
+        if not self.count:
+            return []
+
+        index_map, data_map = self._maps()
+        prefix_bytes = prefix.encode('utf-8')
+        matches = []
+
+        # 还没进索引的新记录都比索引中的新
+        for i in range(self.count - 1, self.indexed - 1, -1):
+            if self._result_startswith(index_map, data_map, i, prefix_bytes):
+                matches.append(i)
+                if len(matches) >= limit:
+                    break
+
+        need = limit - len(matches)
+        prefix_map = self._prefix_entries()
+        if need > 0 and prefix_map is not None:
+            key = prefix_bytes[:PREFIX_SIZE]
+            lo = self._bisect(prefix_map, key)
+            hi = self._bisect(prefix_map, key, right=True, lo=lo)
+            matches.extend(self._search_range(index_map, data_map, prefix_map,
+                                              prefix_bytes, lo, hi, need))
+
+        return [self._read(index_map, data_map, i) for i in matches]
+
+    def _search_range(self, index_map, data_map, prefix_map, prefix_bytes, lo, hi, need):
+        """前缀索引 [lo, hi) 范围内最新的 need 条匹配记录的序号"""
+        count = hi - lo
+        if not count:
+            return []
+
+        if count * count > need * self.indexed * 4:
+            # 匹配的记录很多（例如一个字符的前缀）时，从新到旧扫描通常很快就能找够；
+            # 扫描的条数有上限，找不够再用索引范围
+            found = []
+            budget = 8 * need * self.indexed // count
+            for i in range(self.indexed - 1, max(self.indexed - 1 - budget, -1), -1):
+                if self._result_startswith(index_map, data_map, i, prefix_bytes):
+                    found.append(i)
+                    if len(found) >= need:
+                        return found
+
+        size = PREFIX_ENTRY.size
+        records = (record for _, record in
+                   PREFIX_ENTRY.iter_unpack(prefix_map[lo * size:hi * size]))
+        if len(prefix_bytes) <= PREFIX_SIZE:
+            return heapq.nlargest(need, records)
+
+        found = []
+        for i in sorted(records, reverse=True):
+            if self._result_startswith(index_map, data_map, i, prefix_bytes):
+                found.append(i)
+                if len(found) >= need:
+                    break
+        return found
+
+    def _close_maps(self):
+        for mapped in (self.index_map, self.data_map):
+            if mapped is not None:
+                mapped.close()
+        self.index_map = None
+        self.data_map = None
+
+    def _close_prefix_map(self):
+        if self.prefix_map is not None:
+            self.prefix_map.close()
+            self.prefix_map = None
+
+    def close(self):
+        """关闭文件"""
+        self._close_maps()
+        self._close_prefix_map()
+        self.data_file.close()
+        self.index_file.close()
@@ -0,0 +1,50 @@
+"""
+启动计时
+记录导入、构建界面和第一帧三个阶段的耗时
+设置环境变量 CALCULATOR_STARTUP_TIMING=1 时打印，也可以传入自己的 report 回调
+"""
+
+import os
+import time
+
+
+PHASES = ('import', 'build', 'first_frame')
+PHASE_NAMES = {'import': '导入', 'build': '构建', 'first_frame': '首帧'}
+
+
+def print_report(timings):
+    """默认的报告方式：打印各阶段耗时（毫秒）"""
+    parts = [f"{PHASE_NAMES[phase]}: {timings[phase] * 1000:.0f} ms"
+             for phase in PHASES if phase in timings]
+    print(f"⏱️  启动耗时 {' | '.join(parts)} | 共 {timings['total'] * 1000:.0f} ms")
+
+
+class StartupTimer:
+    """启动阶段计时器，应在导入 GUI 框架之前创建"""
+
+    def __init__(self, report=None):
+        self.start = time.perf_counter()
+        self.marks = {}
+        if report is None and os.environ.get('CALCULATOR_STARTUP_TIMING'):
+            report = print_report
+        self.report = report
+
+    def mark(self, phase):
+        """记录某个阶段结束的时刻"""
+        self.marks[phase] = time.perf_counter() - self.start
+
+    def timings(self):
+        """各阶段各自的耗时（秒），以及总耗时"""
+        timings = {}
+        previous = 0.0
+        for phase in PHASES:
+            if phase in self.marks:
+                timings[phase] = self.marks[phase] - previous
+                previous = self.marks[phase]
+        timings['total'] = previous
+        return timings
+
+    def finish(self):
+        """启动完成，调用报告回调"""
+        if self.report is not None:
+            self.report(self.timings())
@@ -0,0 +1,114 @@
+"""
+计算器按键状态机
+与界面框架无关，Kivy / Toga / Briefcase 前端只负责显示 display
+"""
+
+from calculator.engine import FLOAT, ERROR, OPERATORS, IncrementalEvaluator
+
+
+CLEAR = 'C'
+EQUALS = '='
+
+
+class CalculatorState:
+    """当前输入与显示内容"""
+
+    __slots__ = ('text', 'display', 'has_dot', 'last_was_operator',
+                 'evaluator', 'history')
+
+    def __init__(self, backend=FLOAT, history=None):
+        self.evaluator = IncrementalEvaluator(backend)
+        # 可选的 HistoryStore，每次成功计算后追加一条记录
+        self.history = history
+        self.clear()
+
+    def clear(self):
+        """清空输入"""
+        self.text = ''
+        self.display = ''
+        self.has_dot = False
+        self.last_was_operator = False
+        self.evaluator.reset()
+
+    @property
+    def preview(self):
+        """边输入边计算的预览结果（与显示内容相同时为空）"""
+        if self.last_was_operator or not self.text:
+            return ''
+        preview = self.evaluator.preview()
+        return '' if preview == self.display else preview
+
+    def press(self, key):
+        """处理一次按键，返回新的显示内容"""
+        if key == CLEAR:
+            self.clear()
+        elif key == EQUALS:
+            self.solve()
+        elif key in OPERATORS:
+            self.press_operator(key)
+        elif key == '.':
+            self.press_dot()
+        else:
+            self.append(key)
+            self.last_was_operator = False
+
+        return self.display
+
+    def press_operator(self, key):
+        """运算符：开头只允许负号，连续运算符时替换上一个"""
+        if not self.text:
+            if key == '-':
+                self.append(key)
+                self.last_was_operator = True
+            return
+
+        if self.last_was_operator:
+            if self.text == '-':
+                return
+            # 待定运算符由 evaluator.feed 直接替换
+            self.text = self.text[:-1]
+
+        self.append(key)
+        self.has_dot = False
+        self.last_was_operator = True
+
+    def press_dot(self):
+        """小数点：同一个数字里只允许一个"""
+        if self.has_dot:
+            return
+        self.append('.')
+        self.has_dot = True
+        self.last_was_operator = False
+
+    def append(self, key):
+        self.text += key
+        self.display = self.text
+        self.evaluator.feed(key)
+
+    def solve(self):
+        """计算结果，结果可以继续参与运算"""
+        if not self.text:
+            return
+
+        value = self.evaluator.value()
+        result = None
+        if value is not None and not self.last_was_operator:
+            try:
+                result = self.evaluator.backend.format(value)
+            except (ValueError, RecursionError):
+                # 结果的位数超过整数转字符串的上限
+                pass
+
+        if result is None:
+            self.display = ERROR
+            self.text = ''
+            self.has_dot = False
+            self.evaluator.reset()
+        else:
+            if self.history is not None:
+                self.history.append(self.text, result)
+            self.display = result
+            self.text = result
+            self.has_dot = '.' in result or 'e' in result
+            self.evaluator.load(result)
+        self.last_was_operator = False
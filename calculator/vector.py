@@ -0,0 +1,97 @@
+"""
+向量化计算（需要 NumPy）
+表达式编译一次，然后在整列数据上一次算完，例如:
+
+    expression = compile_vector('a*b-c/d')
+    values, errors = expression.evaluate(a=a, b=b, c=c, d=d)
+
+errors 是逐元素的布尔掩码，对应标量计算中的 'Error'（除零），
+这些位置的 values 为 nan。
+
+整数和布尔数组先转为 float64 再计算：int64 溢出时会静默回绕（2**40 * 2**40 得到 0），
+转为浮点数后大数只损失精度，与标量计算的 float 结果一致。
+"""
+
+from calculator.engine import (
+    FLOAT, ExpressionError, LOAD, NEG, PUSH, compile_expression,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+VECTOR_BINARY = {
+    '+': 'add',
+    '-': 'subtract',
+    '*': 'multiply',
+    '/': 'true_divide',
+}
+
+
+def as_array(value):
+    """转为 NumPy 数组，整数和布尔数组转为 float64"""
+    array = np.asarray(value)
+    if array.dtype.kind in 'biu':
+        return array.astype(np.float64)
+    return array
+
+
+class VectorExpression:
+    """在 NumPy 数组上计算的表达式"""
+
+    __slots__ = ('compiled',)
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    @property
+    def variables(self):
+        return self.compiled.variables
+
+    def evaluate(self, **arrays):
+        """返回 (结果数组, 错误掩码)"""
+        missing = [name for name in self.variables if name not in arrays]
+        if missing:
+            raise ExpressionError(f"缺少变量: {', '.join(missing)}")
+
+        env = {name: as_array(arrays[name]) for name in self.variables}
+        shape = np.broadcast_shapes(*(value.shape for value in env.values()))
+        errors = np.zeros(shape, dtype=bool)
+
+        stack = []
+        push = stack.append
+        pop = stack.pop
+
+        # 浮点数溢出得到 inf，和标量的 float 运算一样不报错
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for op, arg in self.compiled.bind(FLOAT):
+                if op is PUSH:
+                    push(arg)
+                elif op is LOAD:
+                    push(env[arg])
+                elif op is NEG:
+                    stack[-1] = np.negative(stack[-1])
+                else:
+                    right = pop()
+                    if op == '/':
+                        errors |= np.equal(right, 0)
+                    stack[-1] = getattr(np, VECTOR_BINARY[op])(stack[-1], right)
+
+        values = np.broadcast_to(stack[0], shape)
+        if errors.any():
+            values = np.where(errors, np.nan, values)
+        return values, errors
+
+
+def compile_vector(text):
+    """编译用于数组计算的表达式"""
+    if np is None:
+        raise ImportError("向量化计算需要 NumPy: pip install numpy")
+    return VectorExpression(compile_expression(text))
+
+
+def evaluate_arrays(text, **arrays):
+    """编译并计算，返回 (结果数组, 错误掩码)"""
+    return compile_vector(text).evaluate(**arrays)
@@ -1,76 +1,90 @@
+from calculator.startup import StartupTimer
+
+# 必须在导入 Kivy 之前开始计时
+startup = StartupTimer()
+
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
+from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
 
+from calculator.state import CalculatorState
+
+startup.mark('import')
+
+# 键盘布局：每个字符串是一行，每个字符是一个按键
+KEYPAD = (
+    '789/',
+    '456*',
+    '123-',
+    '.0C+',
+    '=',
+)
+
 
 class CalculatorApp(App):
     def build(self):
-        self.operators = ['+', '-', '*', '/']
-        self.last_was_operator = None
-        self.last_button = None
-        
+        self.state = CalculatorState()
+        # 历史记录在第一帧之后再打开
+        self.history = None
+
         main_layout = BoxLayout(orientation='vertical')
         self.solution = TextInput(
             multiline=False, readonly=True, halign='right',
             font_size=55, size_hint=(1, 0.2)
         )
         main_layout.add_widget(self.solution)
-        
-        buttons = [
-            ['7', '8', '9', '/'],
-            ['4', '5', '6', '*'],
-            ['1', '2', '3', '-'],
-            ['.', '0', 'C', '+'],
-        ]
-        
-        for row in buttons:
+
+        # 边输入边计算的预览结果
+        self.preview = Label(
+            halign='right', valign='middle',
+            font_size=28, size_hint=(1, 0.1)
+        )
+        self.preview.bind(size=self.preview.setter('text_size'))
+        main_layout.add_widget(self.preview)
+
+        # 按静态布局一次创建所有按键，事件在构造时直接绑定
+        for row in KEYPAD:
             h_layout = BoxLayout()
             for label in row:
-                button = Button(
-                    text=label,
-                    pos_hint={'center_x': 0.5, 'center_y': 0.5},
-                    font_size=32
-                )
-                button.bind(on_press=self.on_button_press)
-                h_layout.add_widget(button)
+                h_layout.add_widget(Button(
+                    text=label, font_size=32,
+                    on_press=self.on_button_press
+                ))
             main_layout.add_widget(h_layout)
-        
-        equals_button = Button(
-            text='=', pos_hint={'center_x': 0.5, 'center_y': 0.5},
-            font_size=32
-        )
-        equals_button.bind(on_press=self.on_solution)
-        main_layout.add_widget(equals_button)
-        
+
+        startup.mark('build')
         return main_layout
-    
+
+    def on_start(self):
+        from kivy.core.window import Window
+        Window.bind(on_flip=self.on_first_frame)
+
+    def on_first_frame(self, window):
+        """第一帧已经显示"""
+        window.unbind(on_flip=self.on_first_frame)
+        startup.mark('first_frame')
+        startup.finish()
+
+        # 非关键的初始化放到第一帧之后
+        Clock.schedule_once(self.open_history)
+
+    def open_history(self, dt):
+        import os
+        from calculator.history import HistoryStore
+
+        self.history = HistoryStore(os.path.join(self.user_data_dir, 'history'))
+        self.state.history = self.history
+
+    def on_stop(self):
+        if self.history is not None:
+            self.history.close()
+
     def on_button_press(self, instance):
-        current = self.solution.text
-        button_text = instance.text
-        
-        if button_text == 'C':
-            self.solution.text = ''
-        else:
-            if current and (
-                self.last_was_operator and button_text in self.operators):
-                return
-            elif current == '' and button_text in self.operators:
-                return
-            else:
-                new_text = current + button_text
-                self.solution.text = new_text
-        self.last_button = button_text
-        self.last_was_operator = self.last_button in self.operators
-    
-    def on_solution(self, instance):
-        text = self.solution.text
-        if text:
-            try:
-                solution = str(eval(self.solution.text))
-                self.solution.text = solution
-            except Exception:
-                self.solution.text = 'Error'
+        self.solution.text = self.state.press(instance.text)
+        self.preview.text = self.state.preview
 
 
 if __name__ == '__main__':
@@ -2,12 +2,14 @@ import toga
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW
 
+from calculator.history import HistoryStore
+from calculator.state import CalculatorState
+
 
 class Calculator(toga.App):
     def startup(self):
-        self.current_input = ""
-        self.last_operator = None
-        self.last_value = None
+        self.history = HistoryStore(str(self.paths.data / 'history'))
+        self.state = CalculatorState(history=self.history)
         
         main_box = toga.Box(style=Pack(direction=COLUMN, padding=10))
         
@@ -18,6 +20,13 @@ class Calculator(toga.App):
         )
         main_box.add(self.display)
         
+        # 边输入边计算的预览结果
+        self.preview = toga.Label(
+            '',
+            style=Pack(padding=5, font_size=14, text_align='right')
+        )
+        main_box.add(self.preview)
+        
         # 按钮布局
         buttons = [
             ['7', '8', '9', '/'],
@@ -42,23 +51,13 @@ class Calculator(toga.App):
         self.main_window.content = main_box
         self.main_window.show()
     
+    def on_exit(self):
+        self.history.close()
+        return True
+    
     def on_button_press(self, widget):
-        label = widget.label
-        
-        if label == 'C':
-            self.current_input = ""
-            self.display.value = ""
-        elif label == '=':
-            try:
-                result = str(eval(self.current_input))
-                self.display.value = result
-                self.current_input = result
-            except:
-                self.display.value = "Error"
-                self.current_input = ""
-        else:
-            self.current_input += label
-            self.display.value = self.current_input
+        self.display.value = self.state.press(widget.label)
+        self.preview.text = self.state.preview
 
 
 def main():
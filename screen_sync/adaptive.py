@@ -0,0 +1,115 @@
+"""
+屏幕同步 - 自适应码率
+根据发送耗时和服务器反馈的接收端队列深度调整 JPEG 质量、缩放比例和帧率
+
+拥塞（发送耗时接近帧间隔、接收端队列满或有丢帧）时乘性降低：先降质量，再缩小，最后降帧率；
+链路空闲一段时间后加性恢复，顺序相反。所有参数都限制在配置的范围内。
+"""
+
+import threading
+import time
+
+
+DEFAULT_BOUNDS = {
+    'min_quality': 30,
+    'max_quality': 85,
+    'min_scale': 0.5,
+    'max_scale': 1.0,
+    'min_fps': 1,
+    'max_fps': 10,
+}
+
+# 每隔多久调整一次（秒）
+ADJUST_INTERVAL = 1.0
+# 降低之后至少等多久才开始恢复（秒）
+HOLD_AFTER_DECREASE = 3.0
+# 发送耗时占帧间隔的比例：超过 CONGESTED 视为拥塞，低于 IDLE 视为空闲
+CONGESTED = 0.8
+IDLE = 0.3
+# 发送耗时的指数平均系数
+SMOOTHING = 0.3
+
+
+class RateController:
+    """码率控制器，当前的工作点是 quality / scale / fps"""
+
+    def __init__(self, quality=75, scale=1.0, fps=4, **bounds):
+        self.bounds = dict(DEFAULT_BOUNDS)
+        self.bounds.update(bounds)
+
+        self.quality = self.clamp('quality', quality)
+        self.scale = self.clamp('scale', scale)
+        self.fps = self.clamp('fps', fps)
+
+        self.send_time = 0.0
+        self.queue_depth = 0
+        self.dropped = 0
+
+        # 发送线程和反馈线程都会更新
+        self.lock = threading.Lock()
+        self.last_adjust = time.monotonic()
+        self.last_decrease = 0.0
+        self.stats = {'decreases': 0, 'increases': 0}
+
+    def clamp(self, name, value):
+        return max(self.bounds['min_' + name], min(self.bounds['max_' + name], value))
+
+    @property
+    def frame_interval(self):
+        return 1.0 / self.fps
+
+    def on_send(self, seconds):
+        """记录一帧的发送耗时"""
+        with self.lock:
+            self.send_time += (seconds - self.send_time) * SMOOTHING
+            self.maybe_adjust()
+
+    def on_feedback(self, feedback):
+        """服务器反馈：接收端中最深的队列和新增的丢帧数"""
+        with self.lock:
+            self.queue_depth = feedback.get('queue', 0)
+            self.dropped += feedback.get('dropped', 0)
+            self.maybe_adjust()
+
+    def maybe_adjust(self):
+        now = time.monotonic()
+        if now - self.last_adjust < ADJUST_INTERVAL:
+            return
+        self.last_adjust = now
+
+        load = self.send_time / self.frame_interval
+        if load > CONGESTED or self.dropped or self.queue_depth > 1:
+            self.decrease()
+            self.last_decrease = now
+        elif load < IDLE and not self.queue_depth and now - self.last_decrease >= HOLD_AFTER_DECREASE:
+            self.increase()
+
+        self.dropped = 0
+
+    def decrease(self):
+        """乘性降低一个参数"""
+        if self.quality > self.bounds['min_quality']:
+            self.quality = self.clamp('quality', int(self.quality * 0.8))
+        elif self.scale > self.bounds['min_scale']:
+            self.scale = self.clamp('scale', round(self.scale * 0.85, 2))
+        elif self.fps > self.bounds['min_fps']:
+            self.fps = self.clamp('fps', self.fps * 0.75)
+        else:
+            return
+        self.stats['decreases'] += 1
+
+    def increase(self):
+        """加性恢复一个参数"""
+        if self.fps < self.bounds['max_fps']:
+            self.fps = self.clamp('fps', self.fps + 1)
+        elif self.scale < self.bounds['max_scale']:
+            self.scale = self.clamp('scale', round(self.scale + 0.05, 2))
+        elif self.quality < self.bounds['max_quality']:
+            self.quality = self.clamp('quality', self.quality + 5)
+        else:
+            return
+        self.stats['increases'] += 1
+
+    def describe(self):
+        """当前工作点，用于统计行"""
+        return f"质量: {self.quality} | 缩放: {self.scale:.2f} | 目标帧率: {self.fps:.1f}"
@@ -0,0 +1,163 @@
+"""
+屏幕同步 - 截图后端
+截图区域按屏幕尺寸缓存，不再每帧先截一次全屏只为了取尺寸
+
+- ImageGrabCapture: Pillow 的 ImageGrab（Windows/macOS/X11）
+- SyntheticCapture: 合成画面，不需要显示器，Linux 上测试和基准测试用
+
+用环境变量 SCREEN_SYNC_CAPTURE=synthetic 切换后端；
+python capture.py [后端] [帧数] 测量截图和 JPEG 压缩的耗时
+"""
+
+import io
+import os
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+
+# 没有廉价的分辨率查询时，隔多久重新确认一次屏幕尺寸（秒）
+RECHECK_INTERVAL = 10.0
+
+
+def right_quarter(width, height):
+    """屏幕右侧 1/4 区域（左边界向左扩展 20px）"""
+    return (width * 3 // 4 - 20, 0, width, height)
+
+
+class ImageGrabCapture:
+    name = 'imagegrab'
+
+    def __init__(self):
+        from PIL import ImageGrab
+        self.image_grab = ImageGrab
+        self.user32 = None
+        if sys.platform == 'win32':
+            import ctypes
+            self.user32 = ctypes.windll.user32
+
+    def geometry_token(self):
+        """廉价的分辨率变化检测；不支持时返回 None"""
+        if self.user32 is None:
+            return None
+        # SM_CXSCREEN / SM_CYSCREEN；只用来判断是否变化，真实尺寸以截图为准（DPI 缩放）
+        return self.user32.GetSystemMetrics(0), self.user32.GetSystemMetrics(1)
+
+    def screen_size(self):
+        return self.image_grab.grab().size
+
+    def grab(self, bbox):
+        return self.image_grab.grab(bbox=bbox)
+
+
+class SyntheticCapture:
+    """合成画面：静态背景加一个移动的色块，每帧只有一小部分变化"""
+    name = 'synthetic'
+
+    def __init__(self, width=1920, height=1080):
+        self.size = (width, height)
+        self.frame = 0
+
+        self.background = Image.new('RGB', self.size, (32, 36, 48))
+        draw = ImageDraw.Draw(self.background)
+        for y in range(0, height, 24):
+            draw.text((8, y), f"{y:5d} " + "synthetic screen " * (width // 120), fill=(200, 200, 200))
+
+    def geometry_token(self):
+        return self.size
+
+    def screen_size(self):
+        return self.size
+
+    def grab(self, bbox):
+        self.frame += 1
+        image = self.background.crop(bbox)
+        left, top = bbox[0], bbox[1]
+        y = (self.frame * 16) % self.size[1]
+        ImageDraw.Draw(image).rectangle(
+            (self.size[0] - 200 - left, y - top, self.size[0] - 100 - left, y + 40 - top),
+            fill=(220, 60, 60)
+        )
+        return image
+
+
+BACKENDS = {
+    'imagegrab': ImageGrabCapture,
+    'synthetic': SyntheticCapture,
+}
+
+
+def get_backend(name=None):
+    """按名称创建截图后端，默认取环境变量 SCREEN_SYNC_CAPTURE"""
+    name = name or os.environ.get('SCREEN_SYNC_CAPTURE') or 'imagegrab'
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"未知的截图后端: {name}")
+
+
+class ScreenGeometry:
+    """缓存截图区域，只在分辨率变化时重新计算"""
+
+    def __init__(self, backend, region=right_quarter, recheck_interval=RECHECK_INTERVAL):
+        self.backend = backend
+        self.region_func = region
+        self.recheck_interval = recheck_interval
+        self.token = None
+        self.bbox = None
+        self.checked = 0.0
+
+    def invalidate(self):
+        """下次取区域时重新读取屏幕尺寸（例如截图失败之后）"""
+        self.bbox = None
+
+    def region(self):
+        token = self.backend.geometry_token()
+        if token is None:
+            stale = time.monotonic() - self.checked >= self.recheck_interval
+        else:
+            stale = token != self.token
+
+        if self.bbox is None or stale:
+            width, height = self.backend.screen_size()
+            self.bbox = self.region_func(width, height)
+            self.token = token
+            self.checked = time.monotonic()
+
+        return self.bbox
+
+
+def benchmark(backend, frames=50, quality=75):
+    """测量每帧截图和压缩的平均耗时（毫秒）"""
+    geometry = ScreenGeometry(backend)
+    grab_time = encode_time = 0.0
+    size = 0
+
+    for _ in range(frames):
+        start = time.perf_counter()
+        image = backend.grab(geometry.region())
+        middle = time.perf_counter()
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        end = time.perf_counter()
+
+        grab_time += middle - start
+        encode_time += end - middle
+        size += buffer.tell()
+
+    return {
+        'grab_ms': grab_time / frames * 1000,
+        'encode_ms': encode_time / frames * 1000,
+        'frame_kb': size / frames / 1024,
+    }
+
+
+if __name__ == "__main__":
+    backend = get_backend(sys.argv[1] if len(sys.argv) > 1 else None)
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    result = benchmark(backend, frames)
+    print(f"⏱️  {backend.name}: 截图 {result['grab_ms']:.1f} ms | "
+          f"压缩 {result['encode_ms']:.1f} ms | "
+          f"每帧 {result['frame_kb']:.1f} KB")
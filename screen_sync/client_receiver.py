@@ -1,38 +1,153 @@
 """
 屏幕同步 - 接收端（客户端）
 从服务器接收屏幕数据并显示
+
+    网络线程 --信箱--> 解码线程 --信箱--> Tk 主线程（after() 定时取帧绘制）
+
+信箱只有一格，新帧覆盖还没处理的旧帧，所以解码再慢也不会阻塞套接字；
+Tk 只在主线程中操作，PhotoImage 尺寸不变时复用
+
+握手时请求版本 2 的协议（见 framing.py），服务器先回复一条 accept；
+旧版服务器没有 accept，直接发长度前缀的帧。
+版本 2 的帧头带截图时刻，接收端统计网络、解码、绘制和端到端（截图到显示）耗时，
+定期报告给服务器（跨机器的耗时需要两端时钟同步，例如 NTP）
+
+指定 playback 时刻时不看实时画面，而是回放服务器录制的帧（服务器需要开启录制，见 recorder.py），
+回放到录制的末尾后停止
+
+网速慢时可以用 tier 选择服务器转码后的画质档位（'medium' / 'small'，见 transcode.py），
+只收到缩小后的关键帧
 """
 
 import socket
-import struct
 import json
 import time
-import io
-from PIL import Image
+from PIL import Image, ImageTk
 import threading
 import tkinter as tk
 from tkinter import ttk
 
+from framing import (
+    CODEC_JSON, FLAG_STAGE_TIMES, PROTOCOL_VERSION, STAGE_TIMES, MessageReader, is_delta,
+    send_json, send_message,
+)
+from metrics import StageTimer
+from tiles import TileCompositor
+
+
+# Tk 主线程检查新帧的间隔（毫秒）
+PAINT_INTERVAL = 15
+# 向服务器报告耗时统计的间隔（秒）
+REPORT_INTERVAL = 2.0
+
+
+def resize_filter(scale):
+    """按缩放比例选择滤波器：比例接近 1 或放大时双线性就够了，大幅缩小时用 BOX 平均"""
+    if scale >= 0.5:
+        return Image.Resampling.BILINEAR
+    return Image.Resampling.BOX
+
+
+class Mailbox:
+    """单格信箱：新内容覆盖还没取走的旧内容"""
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+    
+    def put(self, item):
+        """放入内容，返回是否覆盖了没取走的旧内容"""
+        with self.condition:
+            replaced = self.item is not None
+            self.item = item
+            self.condition.notify()
+        return replaced
+    
+    def take(self, timeout=None):
+        """取走内容；没有内容时最多等待 timeout 秒（None 表示不等待）"""
+        with self.condition:
+            if self.item is None and timeout:
+                self.condition.wait(timeout)
+            item, self.item = self.item, None
+        return item
+
+
+class FrameMailbox(Mailbox):
+    """待解码的帧：关键帧和差分帧各占一格
+
+    差分帧依赖关键帧，所以关键帧只会被更新的关键帧覆盖；
+    放入的是 (帧数据, 帧头)，取出的是 (关键帧, 差分帧)
+    """
+    
+    def put(self, frame):
+        with self.condition:
+            keyframe, delta = self.item or (None, None)
+            replaced = delta is not None
+            if is_delta(frame[0]):
+                delta = frame
+            else:
+                replaced = replaced or keyframe is not None
+                keyframe, delta = frame, None
+            self.item = (keyframe, delta)
+            self.condition.notify()
+        return replaced
+
+
+def list_senders(server_host, server_port):
+    """查询服务器上当前的发送端列表"""
+    sock = socket.create_connection((server_host, server_port))
+    try:
+        send_message(sock, json.dumps({'type': 'list'}).encode('utf-8'))
+        message = MessageReader(sock).read_message()
+        if message is None:
+            return []
+        return json.loads(bytes(message).decode('utf-8'))['senders']
+    finally:
+        sock.close()
+
 
 class ScreenReceiver:
-    def __init__(self, server_host='111.170.6.103', server_port=5003, sender_id='default'):
+    def __init__(self, server_host='111.170.6.103', server_port=5003, sender_id='default',
+                 playback=None, tier=None):
         self.server_host = server_host
         self.server_port = server_port
         self.sender_id = sender_id
+        # 回放的起始时刻（time.time()），None 表示实时画面
+        self.playback = playback
+        # 画质档位，None 表示原始画面
+        self.tier = tier
         self.running = False
         self.socket = None
+        self.reader = None
+        # 与服务器协商的协议版本，收到 accept 之前按旧版处理
+        self.protocol = 1
+        # 把差分帧合成为完整画面（只在解码线程中使用）
+        self.compositor = TileCompositor()
+        self.reset_compositor = False
+        
+        # 网络线程 -> 解码线程 -> Tk 主线程
+        self.incoming = FrameMailbox()
+        self.decoded = Mailbox()
+        # 画布大小，由 Tk 主线程更新，解码线程按它缩放
+        self.view_size = None
         
         self.stats = {
             'frames_received': 0,
             'bytes_received': 0,
+            'frames_shown': 0,
+            'dropped': 0,
             'errors': 0,
             'start_time': None
         }
+        # 各阶段耗时：network 是从压缩完成到收到（发送、服务器排队和网络传输）
+        self.timings = StageTimer(('network', 'decode', 'paint', 'glass_to_glass'))
+        self.last_report = 0.0
         
         # GUI
         self.window = None
         self.canvas = None
         self.photo = None
+        self.image_item = None
         self.status_label = None
     
     def connect(self):
@@ -47,14 +162,31 @@ class ScreenReceiver:
             
             # 发送配置信息（标识为接收端）
             config = {
-                'sender_id': self.sender_id
+                'sender_id': self.sender_id,
+                'protocol': PROTOCOL_VERSION,
+                # 能解码分块差分帧，服务器才会转发差分帧
+                'codecs': ['jpeg', 'tiles'],
+                # 旧版服务器的写法
+                'tiles': True
             }
+            if self.playback is not None:
+                config['playback'] = self.playback
+            if self.tier:
+                config['tier'] = self.tier
             
             config_json = json.dumps(config).encode('utf-8')
-            self.socket.sendall(struct.pack('!I', len(config_json)))
-            self.socket.sendall(config_json)
+            send_message(self.socket, config_json)
+            
+            # 接收缓冲区在连接期间复用
+            self.reader = MessageReader(self.socket)
+            self.protocol = 1
+            self.reset_compositor = True
             
-            print(f"📡 订阅发送端: {self.sender_id}")
+            if self.playback is not None:
+                started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.playback))
+                print(f"📼 回放发送端: {self.sender_id} (从 {started} 开始)")
+            else:
+                print(f"📡 订阅发送端: {self.sender_id}")
             
             return True
         
@@ -62,44 +194,115 @@ class ScreenReceiver:
             print(f"❌ 连接失败: {e}")
             return False
     
-    def recv_exact(self, size):
-        """接收指定大小的数据"""
-        data = b''
-        while len(data) < size:
-            chunk = self.socket.recv(size - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        return data
-    
     def receive_frame(self):
-        """接收一帧"""
+        """接收一帧，返回 (帧数据, 帧头)，连接断开时返回 None；旧版协议没有帧头"""
         try:
-            # 接收帧大小
-            size_data = self.recv_exact(4)
-            if not size_data:
-                return None
-            
-            frame_size = struct.unpack('!I', size_data)[0]
-            
-            # 接收帧数据
-            frame_data = self.recv_exact(frame_size)
-            if not frame_data:
-                return None
+            while True:
+                if self.protocol >= PROTOCOL_VERSION:
+                    frame = self.reader.read_frame()
+                    if frame is None:
+                        return None
+                    header, frame_data = frame
+                    if header.codec == CODEC_JSON:
+                        continue
+                else:
+                    header = None
+                    frame_data = self.reader.read_message()
+                    if frame_data is None:
+                        return None
+                    # JPEG 和差分帧不会以 '{' 开头，这是服务器的 accept
+                    if frame_data[:1] == b'{':
+                        self.accept(frame_data)
+                        continue
+                break
             
+            frame_size = len(frame_data)
             self.stats['frames_received'] += 1
             self.stats['bytes_received'] += frame_size
             
-            # 解码图像
-            image = Image.open(io.BytesIO(frame_data))
+            if header is None:
+                return bytes(frame_data), None
             
-            return image
+            # 网络耗时: 从压缩完成到收到
+            elapsed = time.time() - header.timestamp
+            if header.flags & FLAG_STAGE_TIMES:
+                capture_time, encode_time = STAGE_TIMES.unpack_from(frame_data)
+                elapsed -= capture_time + encode_time
+                frame_data = frame_data[STAGE_TIMES.size:]
+            self.timings.record('network', elapsed)
+            
+            # 复制出来交给解码线程，接收缓冲区马上可以复用
+            return bytes(frame_data), header
         
         except Exception as e:
             print(f"❌ 接收失败: {e}")
             self.stats['errors'] += 1
             return None
     
+    def accept(self, message):
+        """处理服务器的 accept，之后按版本 2 读取"""
+        accept = json.loads(bytes(message).decode('utf-8'))
+        if accept.get('type') == 'accept':
+            self.protocol = min(accept.get('protocol', 1), PROTOCOL_VERSION)
+            print(f"📡 协议: {self.protocol} (编码: {', '.join(accept.get('codecs', []))})")
+    
+    def decode_frame(self, keyframe, delta):
+        """解码并缩放到画布大小（在解码线程中执行）"""
+        if self.reset_compositor:
+            self.reset_compositor = False
+            self.compositor.reset()
+        
+        view_size = self.view_size
+        image = None
+        for frame in (keyframe, delta):
+            if frame is not None:
+                image = self.compositor.decode(frame[0], view_size) or image
+        
+        if image is None or not view_size:
+            return image
+        
+        # 缩放图像以适应画布（JPEG 已经用 draft() 缩小到接近的尺寸）
+        img_width, img_height = image.size
+        scale = min(view_size[0] / img_width, view_size[1] / img_height)
+        new_size = (max(int(img_width * scale), 1), max(int(img_height * scale), 1))
+        if new_size != image.size:
+            image = image.resize(new_size, resize_filter(scale))
+        return image
+    
+    def decode_loop(self):
+        """解码线程：总是解码最新的帧"""
+        while self.running:
+            item = self.incoming.take(timeout=0.5)
+            if item is None:
+                continue
+            
+            try:
+                start = time.perf_counter()
+                image = self.decode_frame(*item)
+                self.timings.record('decode', time.perf_counter() - start)
+            except Exception as e:
+                print(f"❌ 解码失败: {e}")
+                self.stats['errors'] += 1
+                continue
+            
+            if image is not None:
+                # 显示的画面对应最新的那一帧
+                keyframe, delta = item
+                self.decoded.put((image, (delta or keyframe)[1]))
+    
+    def report_stats(self):
+        """定期把各阶段耗时发给服务器"""
+        now = time.monotonic()
+        if now - self.last_report < REPORT_INTERVAL:
+            return
+        self.last_report = now
+        
+        report = {'type': 'stats', 'stages': self.timings.to_dict()}
+        try:
+            send_json(self.socket, report, self.protocol)
+        except OSError:
+            pass
+    
     def create_gui(self):
         """创建 GUI 窗口"""
         self.window = tk.Tk()
@@ -121,43 +324,58 @@ class ScreenReceiver:
         self.window.geometry("800x600")
     
     def update_frame(self, image):
-        """更新显示的帧"""
+        """更新显示的帧（Tk 主线程），图像已经缩放好"""
         if not self.window or not self.canvas:
             return
         
         try:
-            # 获取画布大小
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            
-            if canvas_width <= 1 or canvas_height <= 1:
-                return
-            
-            # 缩放图像以适应画布
-            img_width, img_height = image.size
-            scale = min(canvas_width / img_width, canvas_height / img_height)
+            width, height = image.size
             
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            
-            resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # 转换为 PhotoImage
-            from PIL import ImageTk
-            self.photo = ImageTk.PhotoImage(resized_image)
-            
-            # 清除画布
-            self.canvas.delete("all")
+            # 尺寸不变时把像素贴到原来的 PhotoImage 上，不重新创建
+            if self.photo is not None and \
+                    (self.photo.width(), self.photo.height()) == (width, height):
+                self.photo.paste(image)
+            else:
+                self.photo = ImageTk.PhotoImage(image)
+                if self.image_item is None:
+                    self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+                else:
+                    self.canvas.itemconfig(self.image_item, image=self.photo)
             
             # 居中显示
-            x = (canvas_width - new_width) // 2
-            y = (canvas_height - new_height) // 2
-            
-            self.canvas.create_image(x, y, anchor=tk.NW, image=self.photo)
+            canvas_width, canvas_height = self.view_size
+            self.canvas.coords(self.image_item,
+                               (canvas_width - width) // 2, (canvas_height - height) // 2)
         
         except Exception as e:
             print(f"❌ 更新显示失败: {e}")
     
+    def paint(self):
+        """Tk 主线程：定期取出解码好的帧显示"""
+        if not self.running or not self.window:
+            return
+        
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        if canvas_width > 1 and canvas_height > 1:
+            self.view_size = (canvas_width, canvas_height)
+        
+        item = self.decoded.take()
+        if item is not None and self.view_size:
+            image, header = item
+            start = time.perf_counter()
+            self.update_frame(image)
+            self.timings.record('paint', time.perf_counter() - start)
+            if header is not None:
+                self.timings.record('glass_to_glass', time.time() - header.timestamp)
+            
+            # 更新状态
+            self.stats['frames_shown'] += 1
+            if self.stats['frames_shown'] % 4 == 0:
+                self.update_status()
+        
+        self.window.after(PAINT_INTERVAL, self.paint)
+    
     def update_status(self):
         """更新状态栏"""
         if not self.status_label:
@@ -170,6 +388,7 @@ class ScreenReceiver:
             
             status = (f"帧数: {self.stats['frames_received']} | "
                      f"FPS: {fps:.1f} | "
+                     f"跳过: {self.stats['dropped']} | "
                      f"速率: {mbps:.2f} Mbps | "
                      f"错误: {self.stats['errors']}")
             
@@ -185,20 +404,19 @@ class ScreenReceiver:
         print("\n🚀 开始接收屏幕...")
         print("💡 关闭窗口停止\n")
         
-        frame_count = 0
-        
         while self.running:
-            # 接收帧
-            image = self.receive_frame()
+            # 接收帧，只放进信箱，解码在另一个线程
+            frame_data = self.receive_frame()
             
-            if image:
-                # 更新显示
-                self.update_frame(image)
-                
-                # 更新状态
-                frame_count += 1
-                if frame_count % 4 == 0:
-                    self.update_status()
+            if frame_data is not None:
+                if self.incoming.put(frame_data):
+                    self.stats['dropped'] += 1
+                self.report_stats()
+            elif self.playback is not None:
+                # 画面停在最后一帧
+                print("\n📼 回放结束")
+                self.socket.close()
+                break
             else:
                 print("\n⚠️  接收中断，尝试重连...")
                 time.sleep(2)
@@ -213,9 +431,14 @@ class ScreenReceiver:
         # 创建 GUI
         self.create_gui()
         
-        # 启动接收线程
+        # 启动接收线程和解码线程
         receive_thread = threading.Thread(target=self.receive_loop, daemon=True)
         receive_thread.start()
+        decode_thread = threading.Thread(target=self.decode_loop, daemon=True)
+        decode_thread.start()
+        
+        # 绘制在 Tk 主线程中定时进行
+        self.window.after(PAINT_INTERVAL, self.paint)
         
         # 运行 GUI
         try:
@@ -253,6 +476,9 @@ class ScreenReceiver:
             print(f"总数据量: {self.stats['bytes_received'] / 1024 / 1024:.2f} MB")
             print(f"平均速率: {(self.stats['bytes_received'] * 8 / 1024 / 1024) / elapsed:.2f} Mbps")
             print(f"错误次数: {self.stats['errors']}")
+            for stage, summary in self.timings.summary().items():
+                print(f"{stage}: p50 {summary['p50']} ms | p90 {summary['p90']} ms | "
+                      f"p99 {summary['p99']} ms")
         
         print("=" * 60)
 
@@ -264,21 +490,47 @@ if __name__ == "__main__":
     host = '111.170.6.103'
     port = 5003
     sender_id = 'default'
+    tier = None
+    
+    # 解析命令行参数；--tier <medium|small> 选择画质档位
+    args = sys.argv[1:]
+    if '--tier' in args:
+        index = args.index('--tier')
+        tier = args[index + 1]
+        del args[index:index + 2]
+    if len(args) > 0:
+        host = args[0]
+    if len(args) > 1:
+        port = int(args[1])
+    if len(args) > 2:
+        sender_id = args[2]
+    # 第四个参数是回放的起始时刻：Unix 时间戳，负数表示多少秒之前
+    playback = None
+    if len(args) > 3:
+        playback = float(args[3])
+        if playback < 0:
+            playback += time.time()
     
-    # 解析命令行参数
-    if len(sys.argv) > 1:
-        host = sys.argv[1]
-    if len(sys.argv) > 2:
-        port = int(sys.argv[2])
-    if len(sys.argv) > 3:
-        sender_id = sys.argv[3]
+    # python client_receiver.py <host> <port> --list 只列出发送端
+    if sender_id == '--list':
+        senders = list_senders(host, port)
+        print(f"发送端数量: {len(senders)}")
+        for info in senders:
+            print(f"  [{info['sender_id']}] {info['address']} "
+                  f"{info['width']}x{info['height']} @ {info['fps']} FPS | "
+                  f"帧数: {info['frames']} | 接收端: {info['receivers']}")
+        sys.exit(0)
     
     print("=" * 60)
     print("屏幕同步 - 接收端")
     print("=" * 60)
     print(f"服务器: {host}:{port}")
     print(f"发送端 ID: {sender_id}")
+    if playback is not None:
+        print(f"回放: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(playback))}")
+    if tier:
+        print(f"画质: {tier}")
     print("=" * 60)
     
-    receiver = ScreenReceiver(host, port, sender_id)
+    receiver = ScreenReceiver(host, port, sender_id, playback, tier)
     receiver.start()
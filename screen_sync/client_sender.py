@@ -1,62 +1,188 @@
 """
 屏幕同步 - 发送端（客户端）
 捕获屏幕右侧 1/4 区域，每秒 4 帧发送到服务器
+
+握手时请求版本 2 的协议（见 framing.py），每帧的帧头带编码、序号和截图时刻，
+消息体前面附带截图和压缩耗时，服务器和接收端据此统计各阶段耗时；
+服务器不支持时（没有回复 accept）退回 4 字节长度前缀
+
+截图、压缩、发送是三级流水线：
+    截图线程 --> 压缩线程池 --> 有界队列 --> 发送（主线程）
+压缩第 N 帧的同时发送第 N-1 帧，帧率只受最慢的一级限制；
+队列满时截图线程等待，不会无限堆积
 """
 
 import socket
 import time
-import struct
 import io
-from PIL import ImageGrab
+import queue
 import threading
 import json
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from adaptive import DEFAULT_BOUNDS, RateController
+from capture import ScreenGeometry, get_backend
+from framing import (
+    CODEC_JPEG, CODEC_TILES, FLAG_KEYFRAME, FLAG_STAGE_TIMES, PROTOCOL_VERSION, STAGE_TIMES,
+    MessageReader, is_delta, send_message, send_frame as send_framed,
+)
+from metrics import StageTimer
+from tiles import TileEncoder
+
+
+# 压缩线程数（Pillow 压缩 JPEG 时释放 GIL，可以真正并行）
+ENCODER_WORKERS = 2
+# 截图线程最多领先发送多少帧
+PIPELINE_DEPTH = 2
+# 等待服务器 accept 的时间，超时按旧版服务器处理
+ACCEPT_TIMEOUT = 2.0
 
 
 class ScreenSender:
-    def __init__(self, server_host='111.170.6.103', server_port=5003, fps=4):
+    def __init__(self, server_host='111.170.6.103', server_port=5003, fps=4, sender_id=None,
+                 encoding='jpeg', capture=None, adaptive=True):
         self.server_host = server_host
         self.server_port = server_port
         self.fps = fps
-        self.frame_interval = 1.0 / fps
+        # 多台机器推流到同一个服务器时用来区分，不设置时服务器使用 'default'
+        self.sender_id = sender_id
+        # 'jpeg': 每帧完整 JPEG；'tiles': 只发送变化的块（见 tiles.py）
+        self.encoding = encoding
+        self.encoder = TileEncoder() if encoding == 'tiles' else None
+        # 截图后端和缓存的截图区域
+        self.capture = get_backend(capture)
+        self.geometry = ScreenGeometry(self.capture)
+        
+        # 自适应码率：True 使用默认范围，也可以传入范围 dict（见 config.example.json）
+        self.controller = None
+        if adaptive:
+            bounds = dict(adaptive) if isinstance(adaptive, dict) else {}
+            bounds.setdefault('max_fps', max(DEFAULT_BOUNDS['max_fps'], fps))
+            self.controller = RateController(quality=75, fps=fps, **bounds)
+        
         self.running = False
         self.socket = None
+        # 与服务器协商的协议版本（1 为旧版长度前缀）
+        self.protocol = 1
+        
+        # 流水线：按截图顺序排队的压缩任务（Future）
+        self.pipeline = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.pool = None
+        self.capture_thread = None
+        
         self.stats = {
             'frames_sent': 0,
             'bytes_sent': 0,
             'errors': 0,
             'start_time': None
         }
+        # 帧序号和各阶段耗时
+        self.seq = 0
+        self.timings = StageTimer(('capture', 'encode', 'send'))
+    
+    @property
+    def frame_interval(self):
+        if self.controller:
+            return self.controller.frame_interval
+        return 1.0 / self.fps
+    
+    @property
+    def quality(self):
+        return self.controller.quality if self.controller else 75
     
     def get_screen_region(self):
-        """获取屏幕右侧 1/4 区域（左边界向左扩展 20px）"""
-        # 获取屏幕尺寸
-        screen = ImageGrab.grab()
-        width, height = screen.size
-        
-        # 计算右侧 1/4 区域，左边界向左移动 20px
-        left = width * 3 // 4 - 20
-        top = 0
-        right = width
-        bottom = height
-        
-        return (left, top, right, bottom)
+        """获取屏幕右侧 1/4 区域（左边界向左扩展 20px），分辨率不变时使用缓存"""
+        return self.geometry.region()
     
-    def capture_frame(self):
-        """捕获一帧"""
+    def grab_frame(self):
+        """截图，返回待压缩的任务；失败或画面没有变化时返回 None（按帧的顺序调用）"""
         try:
             region = self.get_screen_region()
-            screenshot = ImageGrab.grab(bbox=region)
+            screenshot = self.capture.grab(region)
+            
+            # 自适应码率要求缩小时先缩小再压缩
+            scale = self.controller.scale if self.controller else 1.0
+            if scale < 1.0:
+                width, height = screenshot.size
+                screenshot = screenshot.resize(
+                    (max(int(width * scale), 1), max(int(height * scale), 1)),
+                    Image.Resampling.BILINEAR)
+            
+            if self.encoder:
+                # 决定发关键帧还是差分帧，画面没有变化时返回 None
+                self.encoder.quality = self.quality
+                return self.encoder.plan(screenshot)
+            
+            return screenshot
+        
+        except Exception as e:
+            print(f"❌ 捕获失败: {e}")
+            # 可能是分辨率变了，下一帧重新读取屏幕尺寸
+            self.geometry.invalidate()
+            return None
+    
+    def encode_frame(self, job):
+        """压缩一帧（在线程池中执行，不修改共享状态）"""
+        try:
+            if self.encoder:
+                return self.encoder.render(job)
             
             # 压缩为 JPEG
             buffer = io.BytesIO()
-            screenshot.save(buffer, format='JPEG', quality=75, optimize=True)
+            job.save(buffer, format='JPEG', quality=self.quality, optimize=True)
             
             return buffer.getvalue()
         
         except Exception as e:
-            print(f"❌ 捕获失败: {e}")
+            print(f"❌ 压缩失败: {e}")
             return None
     
+    def capture_frame(self):
+        """捕获并压缩一帧（不经过流水线）"""
+        job = self.grab_frame()
+        if job is None:
+            return None
+        return self.encode_frame(job)
+    
+    def timed_encode(self, job):
+        """压缩一帧，同时返回压缩耗时"""
+        start = time.perf_counter()
+        frame_data = self.encode_frame(job)
+        return frame_data, time.perf_counter() - start
+    
+    def capture_loop(self):
+        """截图线程：按帧率截图，把压缩任务按顺序放入流水线"""
+        next_frame = time.monotonic()
+        
+        while self.running:
+            captured_at = time.time()
+            start = time.perf_counter()
+            job = self.grab_frame()
+            capture_time = time.perf_counter() - start
+            
+            if job is not None:
+                try:
+                    future = self.pool.submit(self.timed_encode, job)
+                except RuntimeError:
+                    # 已经停止，线程池已关闭
+                    break
+                # 队列满说明压缩或发送跟不上，在这里等待
+                while self.running:
+                    try:
+                        self.pipeline.put((future, captured_at, capture_time), timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+            
+            # 按固定节拍截图，落后时不补帧
+            next_frame += self.frame_interval
+            sleep_time = next_frame - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            else:
+                next_frame = time.monotonic()
+    
     def connect(self):
         """连接到服务器"""
         try:
@@ -73,32 +199,82 @@ class ScreenSender:
                 'fps': self.fps,
                 'region': region,
                 'width': region[2] - region[0],
-                'height': region[3] - region[1]
+                'height': region[3] - region[1],
+                'encoding': self.encoding,
+                # 需要服务器反馈接收端的队列深度
+                'feedback': bool(self.controller),
+                'protocol': PROTOCOL_VERSION,
+                'codecs': [self.encoding]
             }
+            if self.sender_id:
+                config['sender_id'] = self.sender_id
             
             config_json = json.dumps(config).encode('utf-8')
-            self.socket.sendall(struct.pack('!I', len(config_json)))
-            self.socket.sendall(config_json)
+            send_message(self.socket, config_json)
+            
+            reader = MessageReader(self.socket, 4096)
+            self.protocol = self.negotiate(reader)
             
+            print(f"📡 协议: {self.protocol}")
             print(f"📐 区域: {region}")
             print(f"📊 分辨率: {config['width']}x{config['height']}")
             print(f"🎬 帧率: {self.fps} FPS")
             
+            if self.encoder:
+                # 新连接从关键帧开始
+                self.encoder.request_keyframe()
+            
+            if self.controller:
+                threading.Thread(target=self.feedback_loop, args=(self.socket, reader),
+                                 daemon=True).start()
+            
             return True
         
         except Exception as e:
             print(f"❌ 连接失败: {e}")
             return False
     
-    def send_frame(self, frame_data):
-        """发送一帧数据"""
+    def negotiate(self, reader):
+        """等待服务器的 accept，返回协议版本；旧版服务器不回复，按版本 1 处理"""
+        self.socket.settimeout(ACCEPT_TIMEOUT)
+        try:
+            message = reader.read_message()
+        except socket.timeout:
+            return 1
+        finally:
+            self.socket.settimeout(None)
+        
+        if message is None:
+            raise ConnectionError("服务器关闭了连接")
+        accept = json.loads(bytes(message).decode('utf-8'))
+        if accept.get('type') != 'accept':
+            return 1
+        if accept.get('sender_id'):
+            print(f"🏷️  服务器分配的 ID: {accept['sender_id']}")
+        return min(accept.get('protocol', 1), PROTOCOL_VERSION)
+    
+    def send_frame(self, frame_data, seq=0, captured_at=0.0, stage_times=None):
+        """发送一帧数据，stage_times 是 (截图耗时, 压缩耗时)"""
         try:
-            # 发送帧大小
             frame_size = len(frame_data)
-            self.socket.sendall(struct.pack('!I', frame_size))
+            send_start = time.perf_counter()
+            if self.protocol >= PROTOCOL_VERSION:
+                # 帧头、耗时和帧数据一起发送
+                delta = is_delta(frame_data)
+                flags = 0 if delta else FLAG_KEYFRAME
+                prefix = None
+                if stage_times:
+                    flags |= FLAG_STAGE_TIMES
+                    prefix = STAGE_TIMES.pack(*stage_times)
+                send_framed(self.socket, CODEC_TILES if delta else CODEC_JPEG, frame_data,
+                            flags, seq, captured_at, prefix)
+            else:
+                send_message(self.socket, frame_data)
+            send_time = time.perf_counter() - send_start
             
-            # 发送帧数据
-            self.socket.sendall(frame_data)
+            self.timings.record('send', send_time)
+            if self.controller:
+                self.controller.on_send(send_time)
             
             self.stats['frames_sent'] += 1
             self.stats['bytes_sent'] += frame_size
@@ -110,6 +286,24 @@ class ScreenSender:
             self.stats['errors'] += 1
             return False
     
+    def feedback_loop(self, sock, reader):
+        """读取服务器的反馈（每个连接一个线程，重连后旧线程退出）"""
+        framed = self.protocol >= PROTOCOL_VERSION
+        try:
+            while self.running and self.socket is sock:
+                if framed:
+                    frame = reader.read_frame()
+                    message = frame and frame[1]
+                else:
+                    message = reader.read_message()
+                if message is None:
+                    break
+                feedback = json.loads(bytes(message).decode('utf-8'))
+                if feedback.get('type') == 'feedback':
+                    self.controller.on_feedback(feedback)
+        except (OSError, ValueError):
+            pass
+    
     def print_stats(self):
         """打印统计信息"""
         if self.stats['start_time']:
@@ -120,43 +314,51 @@ class ScreenSender:
             print(f"\r📊 帧数: {self.stats['frames_sent']} | "
                   f"FPS: {fps:.1f} | "
                   f"速率: {mbps:.2f} Mbps | "
-                  f"错误: {self.stats['errors']}", end='')
+                  f"错误: {self.stats['errors']}"
+                  + (f" | {self.controller.describe()}" if self.controller else ''), end='')
     
     def start(self):
         """开始发送"""
+        # 先置位，连接时启动的反馈线程才会运行
+        self.running = True
         if not self.connect():
+            self.running = False
             return
         
-        self.running = True
         self.stats['start_time'] = time.time()
         
         print("\n🚀 开始发送屏幕...")
         print("💡 按 Ctrl+C 停止\n")
         
+        self.pool = ThreadPoolExecutor(max_workers=ENCODER_WORKERS)
+        self.capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.capture_thread.start()
+        
         try:
+            # 发送：按截图顺序取出压缩结果
             while self.running:
-                frame_start = time.time()
+                try:
+                    future, captured_at, capture_time = self.pipeline.get(timeout=0.5)
+                except queue.Empty:
+                    continue
                 
-                # 捕获帧
-                frame_data = self.capture_frame()
+                frame_data, encode_time = future.result()
                 
                 if frame_data:
                     # 发送帧
-                    if not self.send_frame(frame_data):
+                    self.timings.record('capture', capture_time)
+                    self.timings.record('encode', encode_time)
+                    self.seq = (self.seq + 1) & 0xFFFFFFFF
+                    
+                    if not self.send_frame(frame_data, self.seq, captured_at,
+                                           (capture_time, encode_time)):
                         print("\n⚠️  发送失败，尝试重连...")
                         if not self.connect():
                             break
-                
-                # 打印统计
-                if self.stats['frames_sent'] % 4 == 0:
-                    self.print_stats()
-                
-                # 控制帧率
-                elapsed = time.time() - frame_start
-                sleep_time = self.frame_interval - elapsed
-                
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
+                    
+                    # 打印统计
+                    if self.stats['frames_sent'] % 4 == 0:
+                        self.print_stats()
         
         except KeyboardInterrupt:
             print("\n\n⏹️  停止发送")
@@ -168,6 +370,9 @@ class ScreenSender:
         """停止发送"""
         self.running = False
         
+        if self.pool:
+            self.pool.shutdown(wait=False)
+        
         if self.socket:
             try:
                 self.socket.close()
@@ -186,6 +391,9 @@ class ScreenSender:
             print(f"总数据量: {self.stats['bytes_sent'] / 1024 / 1024:.2f} MB")
             print(f"平均速率: {(self.stats['bytes_sent'] * 8 / 1024 / 1024) / elapsed:.2f} Mbps")
             print(f"错误次数: {self.stats['errors']}")
+            for stage, summary in self.timings.summary().items():
+                print(f"{stage}: p50 {summary['p50']} ms | p90 {summary['p90']} ms | "
+                      f"p99 {summary['p99']} ms")
         
         print("=" * 60)
 
@@ -197,6 +405,8 @@ if __name__ == "__main__":
     host = '111.170.6.103'
     port = 5003
     fps = 4
+    sender_id = None
+    encoding = 'jpeg'
     
     # 解析命令行参数
     if len(sys.argv) > 1:
@@ -205,13 +415,19 @@ if __name__ == "__main__":
         port = int(sys.argv[2])
     if len(sys.argv) > 3:
         fps = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        sender_id = sys.argv[4] if sys.argv[4] != 'default' else None
+    if len(sys.argv) > 5:
+        encoding = sys.argv[5]
     
     print("=" * 60)
     print("屏幕同步 - 发送端")
     print("=" * 60)
     print(f"服务器: {host}:{port}")
     print(f"帧率: {fps} FPS")
+    print(f"发送端 ID: {sender_id or 'default'}")
+    print(f"编码: {encoding}")
     print("=" * 60)
     
-    sender = ScreenSender(host, port, fps)
+    sender = ScreenSender(host, port, fps, sender_id, encoding)
     sender.start()
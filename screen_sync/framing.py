@@ -0,0 +1,261 @@
+"""
+屏幕同步 - 分帧工具
+
+握手（以及旧版客户端的所有消息）使用长度前缀消息：
+    <长度 u32（网络字节序）><消息体>
+
+握手配置中声明 "protocol": 2 的客户端，服务器回复一条 accept 消息（仍是长度前缀），
+之后双方的所有消息都使用定长的帧头（FRAME_HEADER）：
+    <魔数 'SF'><版本 u8><编码 u8><标志 u16><序号 u32><截图时刻 f64><长度 u32><消息体>
+
+编码: CODEC_JPEG 完整 JPEG（关键帧）/ CODEC_TILES 分块差分帧 / CODEC_JSON 控制消息
+标志: FLAG_KEYFRAME 关键帧 / FLAG_STAGE_TIMES 消息体前面有 STAGE_TIMES（截图、压缩耗时）
+
+- MessageReader: 阻塞读取，recv_into 到复用的 bytearray，不做 data += chunk 拼接
+- MessageAssembler: 非阻塞读取（服务器事件循环用），每条消息只分配一次，
+  之后把同一个 memoryview 分发给所有接收端
+- send_message / send_frame / send_chunks: 用 sendmsg 一次系统调用写出头部和消息体
+"""
+
+import collections
+import itertools
+import json
+import socket
+import struct
+
+
+LENGTH = struct.Struct('!I')
+# 单个消息（配置或帧）的最大长度
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# 一次 sendmsg 最多携带的数据块数（Linux 的 IOV_MAX 是 1024）
+MAX_IOV = 64
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# 分块差分帧的前 4 个字节（关键帧是普通 JPEG，以 FF D8 开头）
+TILE_MAGIC = b'TILE'
+
+# 版本 2 的帧头
+FRAME_MAGIC = b'SF'
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct('!2sBBHIdI')
+
+CODEC_JPEG = 1
+CODEC_TILES = 2
+CODEC_JSON = 3
+# 握手中用名称声明支持的编码
+CODECS = {'jpeg': CODEC_JPEG, 'tiles': CODEC_TILES}
+
+FLAG_KEYFRAME = 0x1
+FLAG_STAGE_TIMES = 0x2
+
+# FLAG_STAGE_TIMES 时消息体前面的截图耗时、压缩耗时（秒）
+STAGE_TIMES = struct.Struct('!ff')
+
+FrameHeader = collections.namedtuple('FrameHeader', 'codec flags seq timestamp length')
+
+
+class ProtocolError(ValueError):
+    """帧头不合法（魔数或版本不对）"""
+
+
+def pack_length(size):
+    return LENGTH.pack(size)
+
+
+def pack_header(codec, flags, seq, timestamp, length):
+    return FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, codec, flags, seq, timestamp, length)
+
+
+def unpack_header(data):
+    magic, version, codec, flags, seq, timestamp, length = FRAME_HEADER.unpack(data)
+    if magic != FRAME_MAGIC:
+        raise ProtocolError(f"帧头魔数错误: {bytes(magic)!r}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"不支持的协议版本: {version}")
+    return FrameHeader(codec, flags, seq, timestamp, length)
+
+
+def is_delta(payload):
+    """是否是分块差分帧（旧版连接没有编码字段，靠前 4 个字节判断）"""
+    return payload[:4] == TILE_MAGIC
+
+
+def send_chunks(sock, chunks):
+    """尝试发送一组数据块，返回实际发送的字节数（非阻塞套接字可能只发一部分）"""
+    if HAS_SENDMSG and len(chunks) > 1:
+        return sock.sendmsg(list(itertools.islice(chunks, MAX_IOV)))
+    return sock.send(chunks[0])
+
+
+def consume(chunks, sent):
+    """从数据块队列（deque）头部去掉已发送的 sent 字节"""
+    while sent:
+        chunk = chunks[0]
+        size = len(chunk)
+        if sent < size:
+            chunks[0] = memoryview(chunk)[sent:]
+            return
+        chunks.popleft()
+        sent -= size
+
+
+def send_all(sock, parts):
+    """阻塞地发送一组数据块"""
+    if not HAS_SENDMSG:
+        for part in parts:
+            sock.sendall(part)
+        return
+
+    chunks = [memoryview(part) for part in parts]
+    while chunks:
+        sent = sock.sendmsg(chunks)
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks[0])
+            chunks.pop(0)
+        if sent:
+            chunks[0] = chunks[0][sent:]
+
+
+def send_message(sock, payload):
+    """发送一条长度前缀消息（握手和旧版协议）"""
+    send_all(sock, (LENGTH.pack(len(payload)), payload))
+
+
+def send_frame(sock, codec, payload, flags=0, seq=0, timestamp=0.0, prefix=None):
+    """发送一条版本 2 的消息，prefix（例如 STAGE_TIMES）与消息体一起计入长度"""
+    parts = [payload] if prefix is None else [prefix, payload]
+    length = sum(len(part) for part in parts)
+    send_all(sock, [pack_header(codec, flags, seq, timestamp, length)] + parts)
+
+
+def send_json(sock, message, protocol=1):
+    """按连接的协议版本发送一条 JSON 控制消息"""
+    payload = json.dumps(message).encode('utf-8')
+    if protocol >= PROTOCOL_VERSION:
+        send_frame(sock, CODEC_JSON, payload)
+    else:
+        send_message(sock, payload)
+
+
+class MessageReader:
+    """阻塞读取消息，接收缓冲区预先分配并复用
+
+    read_message() / read_frame() 返回指向内部缓冲区的 memoryview，在下一次读取前有效
+    """
+
+    def __init__(self, sock, initial_size=256 * 1024):
+        self.sock = sock
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+
+    def recv_exact(self, size):
+        """接收指定大小的数据，连接关闭时返回 None"""
+        if size > len(self.buffer):
+            # 按需扩大，之后一直复用
+            self.buffer = bytearray(max(size, len(self.buffer) * 2))
+            self.view = memoryview(self.buffer)
+
+        view = self.view[:size]
+        received = 0
+        while received < size:
+            n = self.sock.recv_into(view[received:], size - received)
+            if not n:
+                return None
+            received += n
+        return view
+
+    def read_message(self):
+        """读取一条长度前缀消息，连接关闭时返回 None"""
+        header = self.recv_exact(LENGTH.size)
+        if header is None:
+            return None
+
+        size = LENGTH.unpack(header)[0]
+        if size > MAX_MESSAGE_SIZE:
+            raise ValueError(f"消息过大: {size} 字节")
+
+        return self.recv_exact(size)
+
+    def read_frame(self):
+        """读取一条版本 2 的消息，返回 (FrameHeader, 消息体)，连接关闭时返回 None"""
+        data = self.recv_exact(FRAME_HEADER.size)
+        if data is None:
+            return None
+
+        header = unpack_header(data)
+        if header.length > MAX_MESSAGE_SIZE:
+            raise ValueError(f"消息过大: {header.length} 字节")
+
+        body = self.recv_exact(header.length)
+        if body is None:
+            return None
+        return header, body
+
+
+class MessageAssembler:
+    """非阻塞地拼装消息
+
+    头部读入预分配的缓冲区；知道长度后为消息体分配一次 bytearray，
+    直接 recv_into 进去。完整的消息可以被多个接收端共享，不再复制。
+    握手之后调用 upgrade() 切换到版本 2 的帧头，最近一条消息的帧头在 self.frame_header 中。
+    """
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self.max_size = max_size
+        self.header_struct = LENGTH
+        self.header = bytearray(LENGTH.size)
+        self.header_view = memoryview(self.header)
+        self.frame_header = None
+        self.body = None
+        self.body_view = None
+        self.received = 0
+
+    def upgrade(self):
+        """之后的消息使用版本 2 的帧头（只能在两条消息之间调用）"""
+        self.header_struct = FRAME_HEADER
+        self.header = bytearray(FRAME_HEADER.size)
+        self.header_view = memoryview(self.header)
+
+    def read_from(self, sock):
+        """读一次套接字
+
+        返回完整的消息（bytearray），消息还不完整时返回 None；
+        没有数据可读时抛出 BlockingIOError，连接关闭时抛出 ConnectionError。
+        """
+        if self.body is None:
+            n = sock.recv_into(self.header_view[self.received:])
+            if not n:
+                raise ConnectionResetError("连接已关闭")
+            self.received += n
+            if self.received < len(self.header):
+                return None
+
+            if self.header_struct is LENGTH:
+                size = LENGTH.unpack(self.header)[0]
+            else:
+                self.frame_header = unpack_header(self.header)
+                size = self.frame_header.length
+            if size > self.max_size:
+                raise ValueError(f"消息过大: {size} 字节")
+
+            self.body = bytearray(size)
+            self.body_view = memoryview(self.body)
+            self.received = 0
+            if not size:
+                return self.finish()
+
+        n = sock.recv_into(self.body_view[self.received:])
+        if not n:
+            raise ConnectionResetError("连接已关闭")
+        self.received += n
+        if self.received < len(self.body):
+            return None
+        return self.finish()
+
+    def finish(self):
+        message = self.body
+        self.body = None
+        self.body_view = None
+        self.received = 0
+        return message
@@ -0,0 +1,174 @@
+"""
+屏幕同步 - 多进程服务器压力测试
+
+在本机启动 sharded_server.ShardedServer，用多个发送端（每个一个进程）尽快推送固定大小的帧，
+每个发送端有若干接收端，统计所有接收端收到的总速率。依次测试不同的工作进程数：
+
+    python load_test.py [工作进程数,逗号分隔] [发送端数] [每个发送端的接收端数] [秒数] [帧大小KB]
+    python load_test.py 1,2,4 8 4 10 200
+
+总速率应随工作进程数增加，直到用满 CPU 核数（客户端进程也在本机，会占用一部分 CPU）
+"""
+
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from framing import CODEC_JPEG, FLAG_KEYFRAME, PROTOCOL_VERSION, MessageReader, send_frame, send_message
+from sharded_server import HashRing, ShardedServer, route_key
+
+
+# 开始计数前的预热时间（秒）
+WARMUP = 1.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_server(port, workers):
+    """服务器进程，不打印日志（工作进程继承标准输出）"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    server = ShardedServer('127.0.0.1', port, workers, stats_port=0)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+
+
+def handshake(port, config):
+    """连接服务器，发送配置并读取 accept"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_message(sock, json.dumps(dict(config, protocol=PROTOCOL_VERSION)).encode('utf-8'))
+    reader = MessageReader(sock)
+    reader.read_message()
+    return sock, reader
+
+
+def run_clients(port, sender_id, receivers, duration, frame_size, results):
+    """一个发送端和它的接收端（同一个进程，各自一个线程）"""
+    counts = []
+    readers = []
+    for _ in range(receivers):
+        sock, reader = handshake(port, {'sender_id': sender_id, 'codecs': ['jpeg']})
+        readers.append((sock, reader))
+
+    sender, _ = handshake(port, {'fps': 1000, 'region': [0, 0, 1, 1], 'width': 1, 'height': 1,
+                                 'sender_id': sender_id, 'codecs': ['jpeg']})
+    start = time.time() + WARMUP
+    end = start + duration
+
+    def receive(sock, reader):
+        received = 0
+        frames = 0
+        sock.settimeout(1.0)
+        try:
+            while time.time() < end:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                if time.time() >= start:
+                    received += len(frame[1])
+                    frames += 1
+        except OSError:
+            pass
+        counts.append((received, frames))
+
+    threads = [threading.Thread(target=receive, args=item) for item in readers]
+    for thread in threads:
+        thread.start()
+
+    # JPEG 开头的随机数据，服务器不解码
+    payload = b'\xff\xd8' + os.urandom(frame_size - 2)
+    seq = 0
+    try:
+        while time.time() < end:
+            seq += 1
+            send_frame(sender, CODEC_JPEG, payload, FLAG_KEYFRAME, seq, time.time())
+    except OSError:
+        pass
+
+    for thread in threads:
+        thread.join()
+    sender.close()
+    for sock, _ in readers:
+        sock.close()
+
+    results.put((sum(count[0] for count in counts), sum(count[1] for count in counts)))
+
+
+def measure(workers, senders, receivers, duration, frame_size):
+    """测试一种工作进程数，返回 (总 Mbps, 总帧率)"""
+    port = free_port()
+    server = multiprocessing.Process(target=run_server, args=(port, workers))
+    server.start()
+    time.sleep(0.5 + 0.1 * workers)
+
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(target=run_clients,
+                                args=(port, f"load-{i}", receivers, duration, frame_size, results))
+        for i in range(senders)
+    ]
+    for client in clients:
+        client.start()
+
+    received = 0
+    frames = 0
+    for _ in clients:
+        count = results.get(timeout=duration + 30)
+        received += count[0]
+        frames += count[1]
+    for client in clients:
+        client.join()
+
+    server.terminate()
+    server.join()
+    return received * 8 / 1024 / 1024 / duration, frames / duration
+
+
+if __name__ == "__main__":
+    worker_counts = [1, 2, 4]
+    senders = 8
+    receivers = 4
+    duration = 10
+    frame_kb = 200
+
+    if len(sys.argv) > 1:
+        worker_counts = [int(n) for n in sys.argv[1].split(',')]
+    if len(sys.argv) > 2:
+        senders = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        receivers = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        duration = float(sys.argv[4])
+    if len(sys.argv) > 5:
+        frame_kb = int(sys.argv[5])
+
+    print("=" * 60)
+    print("多进程服务器压力测试")
+    print("=" * 60)
+    print(f"发送端: {senders} | 每个发送端的接收端: {receivers} | 帧大小: {frame_kb} KB | "
+          f"时长: {duration} 秒 | CPU: {os.cpu_count()}")
+    print("=" * 60)
+
+    baseline = None
+    for workers in worker_counts:
+        # 发送端在各工作进程上的分布
+        ring = HashRing(range(workers))
+        spread = [0] * workers
+        for i in range(senders):
+            spread[ring.lookup(route_key(f"load-{i}"))] += 1
+
+        mbps, fps = measure(workers, senders, receivers, duration, frame_kb * 1024)
+        baseline = baseline or mbps
+        print(f"工作进程: {workers} | 总速率: {mbps:.1f} Mbps | 总帧率: {fps:.0f} | "
+              f"倍数: {mbps / baseline:.2f} | 发送端分布: {spread}")
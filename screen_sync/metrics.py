@@ -0,0 +1,99 @@
+"""
+屏幕同步 - 耗时统计
+对数分桶的直方图，记录各阶段耗时并给出分位数（毫秒）
+
+直方图可以转成 dict 通过网络发送，再在服务器上合并；
+各端只需要 Python 标准库
+"""
+
+import bisect
+import math
+
+
+# 桶的上界（毫秒）：0.1 ms 到约 100 s，每档增长 25%
+BUCKETS = [0.1 * 1.25 ** i for i in range(62)]
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """耗时直方图"""
+
+    def __init__(self):
+        # 最后一格是超出所有上界的
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """记录一次耗时（秒）"""
+        ms = seconds * 1000
+        if ms < 0:
+            # 跨机器的时钟偏差
+            ms = 0.0
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """第 p 百分位数（取所在桶的上界，不超过最大值）"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        """计数、平均值和分位数（毫秒）"""
+        result = {
+            'count': self.count,
+            'mean': round(self.total / self.count, 2) if self.count else 0.0,
+            'max': round(self.max, 2),
+        }
+        for p in PERCENTILES:
+            result[f'p{p}'] = round(self.percentile(p), 2)
+        return result
+
+    def to_dict(self):
+        """完整数据（用于发送给服务器）"""
+        return {'counts': self.counts, 'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        counts = data.get('counts', ())
+        if len(counts) == len(histogram.counts):
+            histogram.counts = [int(n) for n in counts]
+            histogram.count = int(data.get('count', 0))
+            histogram.total = float(data.get('total', 0.0))
+            histogram.max = float(data.get('max', 0.0))
+        return histogram
+
+
+class StageTimer:
+    """一组按阶段命名的直方图"""
+
+    def __init__(self, stages):
+        self.histograms = {stage: Histogram() for stage in stages}
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def to_dict(self):
+        return {stage: h.to_dict() for stage, h in self.histograms.items()}
+
+    def summary(self):
+        return {stage: h.summary() for stage, h in self.histograms.items()}
@@ -0,0 +1,354 @@
+"""
+屏幕同步 - 录制和回放
+
+服务器转发的帧按发送端写入分段文件，用于事后查看远程会话显示过什么：
+
+    <目录>/<发送端 ID>/<起始时刻毫秒>.seg   帧数据，每帧是一条版本 2 的消息（帧头 + 消息体，见 framing.py）
+    <目录>/<发送端 ID>/<起始时刻毫秒>.idx   时间索引，每个关键帧一条 INDEX_ENTRY（截图时刻, 在 .seg 中的偏移）
+    <目录>/<发送端 ID>/segments.idx         分段目录，每个分段一条 SEGMENT_ENTRY（起始时刻毫秒），按时间追加
+
+- 每个分段从关键帧开始，超过 SEGMENT_SECONDS 或 SEGMENT_BYTES 后在下一个关键帧处换新分段
+- Recorder 只在事件循环中把帧放进待写列表，由写线程每 FLUSH_INTERVAL 秒批量写入一次，
+  不做 fsync；写线程跟不上时丢弃新帧，不会拖慢转发
+- Archive mmap 分段目录二分查找分段，再 mmap 分段的索引文件二分查找关键帧，
+  定位的开销是录制总时长的对数，不用列出目录
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote
+
+from framing import CODEC_JPEG, FRAME_HEADER, pack_header, unpack_header
+
+
+# 分段的最长时间（秒）和最大大小（字节），超过后在下一个关键帧处换新分段
+SEGMENT_SECONDS = 600
+SEGMENT_BYTES = 256 * 1024 * 1024
+# 批量写入的间隔（秒）
+FLUSH_INTERVAL = 1.0
+# 等待写入的数据上限（字节），超过时丢弃新帧
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# 索引项: (截图时刻, 帧在 .seg 中的偏移)
+INDEX_ENTRY = struct.Struct('!dQ')
+# 分段目录项: 分段的起始时刻（毫秒，也是文件名）
+SEGMENT_ENTRY = struct.Struct('!Q')
+SEGMENT_INDEX = 'segments.idx'
+
+
+def sender_directory(root, sender_id):
+    """发送端的录制目录（ID 中可能有 ':'、'#' 等字符，转义后作为目录名）"""
+    return os.path.join(root, quote(sender_id, safe=''))
+
+
+def list_segments(directory):
+    """列出目录中的分段，返回排序后的起始时刻（毫秒）；只用于没有分段目录的旧录制"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-4]) for name in names
+                  if name.endswith('.seg') and name[:-4].isdigit())
+
+
+def bisect_entries(buffer, count, entry, value):
+    """在按第一个字段排序的定长索引项中二分，返回最后一个 <= value 的项的序号（都大于时为 0）"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if entry.unpack_from(buffer, mid * entry.size)[0] <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return max(lo - 1, 0)
+
+
+class SegmentWriter:
+    """一个发送端正在写入的分段（只在写线程中使用）"""
+
+    def __init__(self, directory, segment_seconds, segment_bytes):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.data = None
+        self.index = None
+        self.segments = None
+        self.last_start = None
+        self.started = 0.0
+        self.size = 0
+
+    def open_segments(self):
+        """打开分段目录；旧录制没有分段目录时先按已有的分段补上"""
+        path = os.path.join(self.directory, SEGMENT_INDEX)
+        if not os.path.exists(path):
+            starts = list_segments(self.directory)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(b''.join(SEGMENT_ENTRY.pack(start) for start in starts))
+            os.replace(path + '.tmp', path)
+        self.segments = open(path, 'ab+')
+        size = self.segments.seek(0, os.SEEK_END)
+        # 丢掉写了一半的项
+        size -= size % SEGMENT_ENTRY.size
+        self.segments.truncate(size)
+        if size:
+            self.segments.seek(size - SEGMENT_ENTRY.size)
+            self.last_start, = SEGMENT_ENTRY.unpack(self.segments.read(SEGMENT_ENTRY.size))
+
+    def open(self, timestamp):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        if self.segments is None:
+            self.open_segments()
+        start = int(timestamp * 1000)
+        name = os.path.join(self.directory, f"{start:013d}")
+        self.data = open(name + '.seg', 'ab', buffering=1024 * 1024)
+        self.index = open(name + '.idx', 'ab')
+        self.started = timestamp
+        self.size = self.data.tell()
+
+        # 分段文件建好后再登记，分段目录里的项总是指向存在的文件；
+        # 同一毫秒重新打开（追加到原来的文件）时不重复登记
+        if self.last_start is None or start > self.last_start:
+            self.segments.write(SEGMENT_ENTRY.pack(start))
+            self.segments.flush()
+            self.last_start = start
+
+    def append(self, header, body):
+        """写入一帧，返回是否开始了新分段"""
+        keyframe = header.codec == CODEC_JPEG
+        rotated = False
+        if keyframe and (self.data is None
+                         or header.timestamp - self.started >= self.segment_seconds
+                         or self.size >= self.segment_bytes):
+            self.open(header.timestamp)
+            rotated = True
+
+        if self.data is None:
+            # 分段必须从关键帧开始，之前的差分帧无法单独解码
+            return False
+
+        if keyframe:
+            self.index.write(INDEX_ENTRY.pack(header.timestamp, self.size))
+        self.data.write(pack_header(header.codec, header.flags, header.seq, header.timestamp, len(body)))
+        self.data.write(body)
+        self.size += FRAME_HEADER.size + len(body)
+        return rotated
+
+    def flush(self):
+        if self.data is not None:
+            # 先写数据再写索引，读取方看到的索引项总是指向已经写出的帧
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        if self.data is not None:
+            self.flush()
+            self.data.close()
+            self.index.close()
+            self.data = None
+            self.index = None
+
+    def close_all(self):
+        """关闭分段和分段目录（停止录制时）"""
+        self.close()
+        if self.segments is not None:
+            self.segments.close()
+            self.segments = None
+
+
+class Recorder:
+    """把转发的帧批量写入分段文件
+
+    record() 在事件循环线程中调用，只把帧放进待写列表；帧数据是只读共享的，不复制。
+    """
+
+    def __init__(self, directory, segment_seconds=SEGMENT_SECONDS, segment_bytes=SEGMENT_BYTES,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING_BYTES):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # 写线程独占
+        self.writers = {}  # {sender_id: SegmentWriter}
+
+        self.stats = {'frames': 0, 'bytes': 0, 'dropped': 0, 'segments': 0, 'batches': 0}
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.running = True
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def record(self, sender_id, header, body):
+        """记录一帧（header 是 FrameHeader，body 是完整的消息体）"""
+        size = len(body)
+        with self.condition:
+            if self.pending_bytes + size > self.max_pending:
+                self.stats['dropped'] += 1
+                return
+            self.pending.append((sender_id, header, body))
+            self.pending_bytes += size
+
+    def write_loop(self):
+        """写线程：每 flush_interval 秒把攒下的帧一次写出"""
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                self.pending_bytes = 0
+                running = self.running
+
+            if batch:
+                try:
+                    self.write_batch(batch)
+                except OSError as e:
+                    print(f"❌ 录制写入失败: {e}")
+                    self.stats['dropped'] += len(batch)
+
+            if not running:
+                break
+
+        for writer in self.writers.values():
+            writer.close_all()
+        self.writers.clear()
+
+    def write_batch(self, batch):
+        touched = set()
+        for sender_id, header, body in batch:
+            writer = self.writers.get(sender_id)
+            if writer is None:
+                writer = SegmentWriter(sender_directory(self.directory, sender_id),
+                                       self.segment_seconds, self.segment_bytes)
+                self.writers[sender_id] = writer
+            if writer.append(header, body):
+                self.stats['segments'] += 1
+            if writer.data is not None:
+                self.stats['frames'] += 1
+                self.stats['bytes'] += len(body)
+            touched.add(writer)
+
+        for writer in touched:
+            writer.flush()
+        self.stats['batches'] += 1
+
+    def stop(self):
+        """写出剩下的帧并关闭所有分段"""
+        if self.thread is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+
+
+class Archive:
+    """读取录制的分段，从指定时刻开始回放"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self, sender_id):
+        """发送端的所有分段，返回 [(起始时刻毫秒, 路径前缀)]，按时间排序"""
+        directory = sender_directory(self.directory, sender_id)
+        try:
+            with open(os.path.join(directory, SEGMENT_INDEX), 'rb') as f:
+                data = f.read()
+            starts = [start for start, in SEGMENT_ENTRY.iter_unpack(
+                data[:len(data) - len(data) % SEGMENT_ENTRY.size])]
+        except FileNotFoundError:
+            starts = list_segments(directory)
+        return [(start, os.path.join(directory, f"{start:013d}")) for start in starts]
+
+    def locate(self, directory, timestamp):
+        """二分查找 timestamp 所在的分段，依次返回从它开始的分段的路径前缀"""
+        try:
+            f = open(os.path.join(directory, SEGMENT_INDEX), 'rb')
+        except FileNotFoundError:
+            # 旧录制没有分段目录
+            starts = list_segments(directory)
+            first = max(bisect.bisect_right(starts, int(timestamp * 1000)) - 1, 0)
+            for start in starts[first:]:
+                yield os.path.join(directory, f"{start:013d}")
+            return
+
+        with f:
+            # 只看打开时已经登记的分段（和正在写入的分段一样，之后新增的不回放）
+            count = os.fstat(f.fileno()).st_size // SEGMENT_ENTRY.size
+            if not count:
+                return
+            with mmap.mmap(f.fileno(), count * SEGMENT_ENTRY.size, access=mmap.ACCESS_READ) as index:
+                first = bisect_entries(index, count, SEGMENT_ENTRY, int(timestamp * 1000))
+                for i in range(first, count):
+                    start, = SEGMENT_ENTRY.unpack_from(index, i * SEGMENT_ENTRY.size)
+                    yield os.path.join(directory, f"{start:013d}")
+
+    def seek(self, path, timestamp):
+        """在分段的索引中二分查找 timestamp 之前最近的关键帧，返回它在 .seg 中的偏移"""
+        with open(path + '.idx', 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // INDEX_ENTRY.size
+            if not count:
+                return 0
+            with mmap.mmap(f.fileno(), count * INDEX_ENTRY.size, access=mmap.ACCESS_READ) as index:
+                entry = bisect_entries(index, count, INDEX_ENTRY, timestamp)
+                return INDEX_ENTRY.unpack_from(index, entry * INDEX_ENTRY.size)[1]
+
+    def frames(self, sender_id, timestamp):
+        """从 timestamp 之前最近的关键帧开始，依次返回 (FrameHeader, 消息体)，直到录制的末尾"""
+        offset = None
+        for path in self.locate(sender_directory(self.directory, sender_id), timestamp):
+            if offset is None:
+                offset = self.seek(path, timestamp)
+            with open(path + '.seg', 'rb') as data:
+                data.seek(offset)
+                while True:
+                    raw = data.read(FRAME_HEADER.size)
+                    if len(raw) < FRAME_HEADER.size:
+                        break
+                    header = unpack_header(raw)
+                    body = data.read(header.length)
+                    if len(body) < header.length:
+                        # 正在写入的分段，最后一帧还没写完
+                        break
+                    yield header, body
+            offset = 0
+
+if __name__ == "__main__":
+    import sys
+
+    # python recorder.py <录制目录> <发送端 ID> [起始时刻]：列出分段和帧
+    root = sys.argv[1] if len(sys.argv) > 1 else 'recordings'
+    sender_id = sys.argv[2] if len(sys.argv) > 2 else 'default'
+    start = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+    archive = Archive(root)
+    segments = archive.segments(sender_id)
+    print(f"📼 {sender_id}: {len(segments)} 个分段")
+    for segment_start, path in segments:
+        print(f"  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(segment_start / 1000))} "
+              f"{os.path.getsize(path + '.seg') / 1024 / 1024:.2f} MB")
+
+    count = 0
+    total = 0
+    first = last = None
+    for header, body in archive.frames(sender_id, start):
+        count += 1
+        total += len(body)
+        first = first or header.timestamp
+        last = header.timestamp
+    if count:
+        print(f"帧数: {count} | 数据: {total / 1024 / 1024:.2f} MB | 时长: {last - first:.1f} 秒")
@@ -8,13 +8,14 @@ import socket
 import threading
 import time
 import json
-import struct
 import io
-from PIL import ImageGrab
 import win32gui
 import win32api
 import win32con
 
+from capture import ScreenGeometry, get_backend
+from framing import MessageReader, send_message
+
 
 class RemoteControlClient:
     def __init__(self, server_host='111.170.6.103', 
@@ -27,6 +28,8 @@ class RemoteControlClient:
         self.screen_sharing_enabled = False
         self.screen_socket = None
         self.screen_thread = None
+        self.capture = get_backend()
+        self.geometry = ScreenGeometry(self.capture)
         
         # 命令接收
         self.command_socket = None
@@ -117,8 +120,7 @@ class RemoteControlClient:
                 }
                 
                 config_json = json.dumps(config).encode('utf-8')
-                self.screen_socket.sendall(struct.pack('!I', len(config_json)))
-                self.screen_socket.sendall(config_json)
+                send_message(self.screen_socket, config_json)
                 
                 print(f"[屏幕共享] 📐 区域: {region}")
                 print(f"[屏幕共享] 📊 分辨率: {config['width']}x{config['height']}")
@@ -159,22 +161,14 @@ class RemoteControlClient:
                 break
     
     def get_screen_region(self):
-        """获取屏幕右侧 1/4 区域"""
-        screen = ImageGrab.grab()
-        width, height = screen.size
-        
-        left = width * 3 // 4 - 20
-        top = 0
-        right = width
-        bottom = height
-        
-        return (left, top, right, bottom)
+        """获取屏幕右侧 1/4 区域，分辨率不变时使用缓存"""
+        return self.geometry.region()
     
     def capture_frame(self):
         """捕获一帧"""
         try:
             region = self.get_screen_region()
-            screenshot = ImageGrab.grab(bbox=region)
+            screenshot = self.capture.grab(region)
             
             buffer = io.BytesIO()
             screenshot.save(buffer, format='JPEG', quality=75, optimize=True)
@@ -182,14 +176,13 @@ class RemoteControlClient:
             return buffer.getvalue()
         except Exception as e:
             print(f"[屏幕共享] ❌ 捕获失败: {e}")
+            self.geometry.invalidate()
             return None
     
     def send_frame(self, frame_data):
         """发送一帧"""
         try:
-            frame_size = len(frame_data)
-            self.screen_socket.sendall(struct.pack('!I', frame_size))
-            self.screen_socket.sendall(frame_data)
+            send_message(self.screen_socket, frame_data)
             return True
         except Exception as e:
             print(f"[屏幕共享] ❌ 发送失败: {e}")
@@ -209,38 +202,22 @@ class RemoteControlClient:
                 print("[命令接收] ✅ 已连接")
                 print("[命令接收] 📡 等待命令...\n")
                 
+                reader = MessageReader(self.command_socket, 4096)
+                
                 # 接收命令
                 while self.running:
-                    # 接收命令长度
-                    size_data = self.recv_exact(self.command_socket, 4)
-                    if not size_data:
-                        break
-                    
-                    cmd_size = struct.unpack('!I', size_data)[0]
-                    
-                    # 接收命令数据
-                    cmd_data = self.recv_exact(self.command_socket, cmd_size)
-                    if not cmd_data:
+                    cmd_data = reader.read_message()
+                    if cmd_data is None:
                         break
                     
                     # 解析命令
-                    command = json.loads(cmd_data.decode('utf-8'))
+                    command = json.loads(str(cmd_data, 'utf-8'))
                     self.handle_command(command)
             
             except Exception as e:
                 print(f"[命令接收] ❌ 错误: {e}")
                 time.sleep(5)
     
-    def recv_exact(self, sock, size):
-        """接收指定大小的数据"""
-        data = b''
-        while len(data) < size:
-            chunk = sock.recv(size - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        return data
-    
     def handle_command(self, command):
         """处理命令"""
         cmd_type = command.get('type')
@@ -5,9 +5,10 @@
 
 import socket
 import json
-import struct
 import sys
 
+from framing import send_message
+
 
 class RemoteControlServer:
     def __init__(self, host='0.0.0.0', command_port=5004):
@@ -149,14 +150,12 @@ class RemoteControlServer:
             return
         
         cmd_json = json.dumps(command).encode('utf-8')
-        cmd_size = struct.pack('!I', len(cmd_json))
         
         dead_clients = []
         
         for client in self.clients:
             try:
-                client['socket'].sendall(cmd_size)
-                client['socket'].sendall(cmd_json)
+                send_message(client['socket'], cmd_json)
             except:
                 dead_clients.append(client)
         
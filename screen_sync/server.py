@@ -2,264 +2,986 @@
 屏幕同步 - 服务器端
 接收客户端发送的屏幕数据，转发给接收端
 支持多个客户端和多个接收端
+
+所有连接由一个 selectors 事件循环处理（不再每个连接一个线程），
+每帧只分配一次，同一个 memoryview 分发给所有接收端
+
+线路协议见 framing.py：客户端先发 4 字节长度 + JSON 配置；
+配置中声明 "protocol": 2 的客户端收到 {"type": "accept", ...} 后改用版本 2 的帧头
+（编码、标志、序号、截图时刻），配置中的 "codecs" 声明支持的编码。
+没有声明的旧版客户端按原来的 4 字节长度 + JPEG 帧服务，只收到关键帧
+
+发送端在配置里用 sender_id 标识自己（旧发送端没有这个字段，归为 'default'），
+接收端按 sender_id 订阅；配置为 {"type": "list"} 的连接会收到一条
+JSON 格式的发送端列表，然后连接关闭
+
+分块差分帧（见 tiles.py）只转发给支持 tiles 编码的接收端
+（旧版接收端在配置中用 "tiles": true 声明）
+
+握手时声明 "feedback" 的发送端会定期收到 JSON 反馈
+{"type": "feedback", "queue": 接收端中最深的队列, "dropped": 新增丢帧数, "receivers": 接收端数}，
+用于自适应码率（见 adaptive.py）
+
+版本 2 的帧头带序号和截图时刻（旧版发送端的帧由服务器补上），发送端可以附带截图、压缩耗时；
+接收端定期发回 {"type": "stats", "stages": {...}} 报告解码、绘制和端到端耗时。
+各阶段耗时的分位数通过 http://127.0.0.1:<统计端口>/stats 以 JSON 提供
+
+服务器缓存每个发送端最近的关键帧（总大小和存放时间有上限），
+新接收端订阅后先收到这一帧，不用等发送端的下一个关键帧
+
+指定录制目录时，转发的帧同时写入分段文件（见 recorder.py）；
+配置中带 "playback": <时刻> 的接收端不订阅实时画面，而是从该时刻开始回放录制的帧
+
+指定上级服务器（upstream）时作为中继：本地有接收端订阅而本地没有这个发送端时，
+以接收端身份向上级服务器订阅，收到的帧像本地发送端的帧一样转发给本地接收端。
+每个发送端只占一份上级带宽；本地最后一个接收端断开时取消订阅，上级断开时按退避时间重连
+
+接收端可以在配置中用 "tier": "medium" / "small" 选择缩小的画质档位（见 transcode.py，需要 Pillow），
+只收到服务器转码后的 JPEG 关键帧；只有某个档位有接收端时才为它转码
 """
 
+import errno
 import socket
+import selectors
 import threading
-import struct
 import json
 import time
-from collections import defaultdict
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from framing import (
+    CODEC_JPEG, CODEC_JSON, CODEC_TILES, CODECS, FLAG_KEYFRAME, FLAG_STAGE_TIMES,
+    PROTOCOL_VERSION, STAGE_TIMES, FrameHeader, MessageAssembler, consume, is_delta,
+    pack_header, pack_length, send_all, send_chunks, unpack_header,
+)
+from metrics import Histogram, StageTimer
+from recorder import Archive, Recorder
+from transcode import DEFAULT_TIER, TIERS, Transcoder
+
+
+# 握手（配置信息）超时
+HANDSHAKE_TIMEOUT = 5.0
+# 一个连接每次可读事件最多处理的读取次数，避免一个发送端占满事件循环
+MAX_READS_PER_EVENT = 16
+# 每个接收端最多排队的关键帧数，超过时丢弃最旧的（只保留最新的）；另外最多再排一个差分帧
+MAX_QUEUED_FRAMES = 2
+# 给发送端发送反馈的最小间隔（秒）
+FEEDBACK_INTERVAL = 0.5
+# 统计接口的端口（只监听本机），0 表示不启用
+STATS_PORT = 8003
+# 关键帧缓存的总大小上限（字节）和每帧的最长保留时间（秒）
+KEYFRAME_CACHE_BYTES = 32 * 1024 * 1024
+KEYFRAME_MAX_AGE = 60.0
+# 回放时两帧之间最多等待多久（秒），录制中长时间没有变化的画面不用干等
+PLAYBACK_MAX_GAP = 5.0
+# 中继重连上级服务器的退避时间（秒），每次失败加倍
+UPSTREAM_RETRY_MIN = 1.0
+UPSTREAM_RETRY_MAX = 30.0
+# 非阻塞 connect 正在进行中
+CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', 0)}
+
+
+class Connection:
+    """一个客户端连接的读写状态"""
+
+    def __init__(self, sock, address, max_queue=MAX_QUEUED_FRAMES):
+        self.sock = sock
+        self.address = address
+        self.role = None  # None（等待配置）/ 'sender' / 'receiver' / 'list' / 'playback' / 'upstream'
+        self.sender_id = None
+        self.connected_at = time.time()
+        self.closed = False
+
+        # 1: 4 字节长度前缀（旧版客户端）/ 2: 版本 2 的帧头
+        self.protocol = 1
+        # 接收端能解码的编码，以及选择的画质档位
+        self.codecs = {CODEC_JPEG}
+        self.tier = DEFAULT_TIER
+
+        # 发送端：订阅它的接收端集合（与 ScreenServer.receivers 中的是同一个对象）
+        self.subscribers = None
+        # 写完当前数据后关闭连接（列表请求）
+        self.close_when_flushed = False
+        # 发送端是否需要队列深度反馈
+        self.wants_feedback = False
+        self.last_feedback = 0.0
+        self.reported_dropped = 0
+        # 旧版发送端的帧序号（由服务器编号）
+        self.seq = 0
+
+        # 接收端：正在发送的帧到达服务器的时刻、每帧在服务器上停留的时间、接收端报告的耗时
+        self.frame_arrived = None
+        self.queue_times = Histogram()
+        self.report = {}
+
+        # 读取消息（握手后可能切换到版本 2 的帧头）
+        self.assembler = MessageAssembler()
+
+        # 正在发送的数据块：已经开始发送的帧不能丢弃，否则数据流会错位
+        self.outbuf = deque()
+        self.writing = False
+
+        # 等待发送的帧: (数据块, 到达时刻, 是否关键帧)，有上限
+        self.frames = deque()
+        self.max_queue = max_queue
+        self.stats = {'frames': 0, 'dropped': 0}
+
+    def queue_frame(self, chunks, arrived=None, keyframe=True):
+        """帧入队；队列满时丢弃旧帧，保证最新的帧能发出去
+
+        差分帧相对于它之前的关键帧，丢掉关键帧而发出后面的差分帧，接收端会把块贴到更早的关键帧上。
+        所以排队的差分帧只会被更新的帧替换（新的差分帧或新的关键帧都包含它的内容），
+        关键帧只在后面还有更新的关键帧时才丢弃，队列里最多是若干关键帧加一个差分帧
+        """
+        frames = self.frames
+        # 排队的差分帧总在最后
+        if frames and not frames[-1][2]:
+            frames.pop()
+            self.stats['dropped'] += 1
+        # 新的差分帧要保留它前面最新的关键帧
+        keep = 0 if keyframe else 1
+        while len(frames) >= self.max_queue and len(frames) > keep:
+            frames.popleft()
+            self.stats['dropped'] += 1
+        frames.append((chunks, arrived, keyframe))
+
+    def queue_message(self, chunks):
+        """控制消息入队，不会被丢弃"""
+        self.outbuf.extend(chunks)
+
+    def has_output(self):
+        return bool(self.outbuf or self.frames)
+
+
+class KeyframeCache:
+    """每个发送端最近的一个关键帧，按存入时间排序
+
+    存的是转发时已经组好的数据块（版本 2 / 旧版各一份），和转发共享同一块帧数据；
+    总大小超过上限时先淘汰最旧的，超过 max_age 的帧不再发送。只在事件循环线程中使用。
+    """
+
+    def __init__(self, max_bytes=KEYFRAME_CACHE_BYTES, max_age=KEYFRAME_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()  # {sender_id: (framed, legacy, size, stored_at)}
+        self.size = 0
+
+    def put(self, sender_id, framed, legacy, size):
+        self.discard(sender_id)
+        if size > self.max_bytes:
+            return
+        self.entries[sender_id] = (framed, legacy, size, time.monotonic())
+        self.size += size
+        while self.size > self.max_bytes:
+            self.pop_oldest()
+
+    def get(self, sender_id):
+        """返回 (版本 2 数据块, 旧版数据块)，没有或已过期时返回 None"""
+        self.expire()
+        entry = self.entries.get(sender_id)
+        return entry and entry[:2]
+
+    def discard(self, sender_id):
+        entry = self.entries.pop(sender_id, None)
+        if entry:
+            self.size -= entry[2]
+
+    def pop_oldest(self):
+        _, entry = self.entries.popitem(last=False)
+        self.size -= entry[2]
+
+    def expire(self):
+        """淘汰超过 max_age 的帧（最旧的在最前面）"""
+        deadline = time.monotonic() - self.max_age
+        while self.entries and next(iter(self.entries.values()))[3] < deadline:
+            self.pop_oldest()
 
 
 class ScreenServer:
-    def __init__(self, host='0.0.0.0', port=5003):
+    def __init__(self, host='0.0.0.0', port=5003, queue_size=MAX_QUEUED_FRAMES,
+                 stats_port=STATS_PORT, record_dir=None, upstream=None):
         self.host = host
         self.port = port
+        self.queue_size = queue_size
+        self.stats_port = stats_port
+        self.stats_http = None
+        # 录制（可选）
+        self.record_dir = record_dir
+        self.recorder = None
         self.running = False
         self.server_socket = None
-        
+        self.selector = None
+
         # 客户端连接（发送端）
-        self.senders = {}  # {client_id: {'socket': socket, 'config': config, 'stats': stats}}
+        self.senders = {}  # {sender_id: {'connection': conn, 'config': config, 'stats': stats}}
         self.sender_lock = threading.Lock()
-        
-        # 接收端连接
-        self.receivers = {}  # {client_id: [socket1, socket2, ...]}
+
+        # 接收端连接，按订阅的发送端索引；接收端可以先于发送端连上
+        self.receivers = {}  # {sender_id: {conn1, conn2, ...}}
         self.receiver_lock = threading.Lock()
-        
+
+        # 尚未完成握手的连接
+        self.pending = set()
+
+        # 每个发送端最近的关键帧，发给新订阅的接收端
+        self.keyframes = KeyframeCache()
+
+        # 中继：上级服务器地址 (host, port)，向上级订阅的连接，以及等待重连的发送端
+        self.upstream = upstream
+        self.upstreams = {}  # {sender_id: conn}
+        self.retries = {}  # {sender_id: (重连时刻, 退避时间)}
+
+        # 转码（第一个选择缩小档位的接收端连上时创建）
+        self.transcoder = None
+
         # 统计
         self.stats = {
             'total_frames': 0,
             'total_bytes': 0,
             'start_time': None
         }
-    
+
     def start(self):
         """启动服务器"""
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)
-            
+            self.listen()
+
             self.running = True
             self.stats['start_time'] = time.time()
-            
-            print("=" * 60)
-            print("屏幕同步服务器")
-            print("=" * 60)
-            print(f"✅ 服务器启动: {self.host}:{self.port}")
-            print("💡 等待连接...\n")
-            
+
             # 启动统计线程
             stats_thread = threading.Thread(target=self.print_stats_loop, daemon=True)
             stats_thread.start()
-            
-            # 接受连接
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    print(f"\n🔌 新连接: {client_address}")
-                    
-                    # 启动处理线程
-                    thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, client_address),
-                        daemon=True
-                    )
-                    thread.start()
-                
-                except Exception as e:
-                    if self.running:
-                        print(f"❌ 接受连接失败: {e}")
-        
+            self.start_stats_http()
+            if self.record_dir:
+                self.recorder = Recorder(self.record_dir)
+                self.recorder.start()
+                print(f"📼 录制到: {self.record_dir}\n")
+
+            self.event_loop()
+
         except Exception as e:
             print(f"❌ 服务器启动失败: {e}")
-        
+
         finally:
             self.stop()
-    
-    def handle_client(self, client_socket, client_address):
-        """处理客户端连接"""
-        try:
-            # 接收客户端类型（sender 或 receiver）
-            client_socket.settimeout(5.0)
-            
-            # 接收配置信息长度
-            size_data = self.recv_exact(client_socket, 4)
-            if not size_data:
-                print(f"⚠️  {client_address} 未发送配置信息")
-                client_socket.close()
+
+    def listen(self):
+        """打开监听套接字，注册到事件循环（data 为 None）"""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(128)
+        self.server_socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+
+        print("=" * 60)
+        print("屏幕同步服务器")
+        print("=" * 60)
+        print(f"✅ 服务器启动: {self.host}:{self.port}")
+        print("💡 等待连接...\n")
+
+    def event_loop(self):
+        """事件循环：处理所有发送端和接收端"""
+        while self.running:
+            events = self.selector.select(timeout=1.0)
+
+            for key, mask in events:
+                if key.data is None:
+                    self.accept_connections()
+                    continue
+                if key.data is self.transcoder:
+                    self.deliver_renditions()
+                    continue
+
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.on_readable(conn)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self.flush(conn)
+
+            self.check_handshake_timeouts()
+            self.check_upstream_retries()
+            self.keyframes.expire()
+
+    def accept_connections(self):
+        """接受所有等待中的连接"""
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except BlockingIOError:
                 return
-            
-            config_size = struct.unpack('!I', size_data)[0]
-            
-            # 接收配置信息
-            config_data = self.recv_exact(client_socket, config_size)
-            if not config_data:
-                print(f"⚠️  {client_address} 配置信息不完整")
-                client_socket.close()
+            except OSError as e:
+                if self.running:
+                    print(f"❌ 接受连接失败: {e}")
                 return
-            
-            config = json.loads(config_data.decode('utf-8'))
-            
-            client_socket.settimeout(None)
-            
-            # 判断客户端类型
-            if 'fps' in config:
-                # 发送端
-                client_id = f"{client_address[0]}:{client_address[1]}"
-                self.handle_sender(client_socket, client_address, client_id, config)
-            else:
-                # 接收端
-                sender_id = config.get('sender_id', 'default')
-                self.handle_receiver(client_socket, client_address, sender_id)
-        
+
+            print(f"\n🔌 新连接: {client_address}")
+            self.add_connection(client_socket, client_address)
+
+    def add_connection(self, client_socket, client_address):
+        """把新连接加入事件循环，等待它的配置信息"""
+        client_socket.setblocking(False)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn = Connection(client_socket, client_address, self.queue_size)
+        self.pending.add(conn)
+        self.selector.register(client_socket, selectors.EVENT_READ, conn)
+        return conn
+
+    def check_handshake_timeouts(self):
+        """关闭迟迟不发送配置信息的连接"""
+        now = time.time()
+        for conn in list(self.pending):
+            if now - conn.connected_at > HANDSHAKE_TIMEOUT:
+                print(f"⚠️  {conn.address} 未发送配置信息")
+                self.close_connection(conn)
+
+    def on_readable(self, conn):
+        """连接可读：消息直接 recv_into 到为它分配的缓冲区"""
+        try:
+            for _ in range(MAX_READS_PER_EVENT):
+                message = conn.assembler.read_from(conn.sock)
+                if message is not None:
+                    self.handle_message(conn, message)
+                    if conn.closed:
+                        return
+        except (BlockingIOError, InterruptedError):
+            pass
+        except ConnectionError:
+            self.close_connection(conn)
         except Exception as e:
-            print(f"❌ 处理客户端失败 {client_address}: {e}")
-            client_socket.close()
-    
-    def handle_sender(self, client_socket, client_address, client_id, config):
-        """处理发送端"""
-        print(f"📤 发送端: {client_address}")
-        print(f"   ID: {client_id}")
+            self.close_connection(conn, e)
+
+    def handle_message(self, conn, message):
+        """处理一条完整的消息"""
+        if conn.role is None:
+            self.handle_client(conn, message)
+        elif conn.role == 'sender':
+            self.handle_frame(conn, message)
+        elif conn.role == 'receiver':
+            self.handle_report(conn, message)
+        elif conn.role == 'upstream':
+            self.handle_upstream(conn, message)
+
+    def handle_client(self, conn, config_data):
+        """处理客户端的配置信息（握手）"""
+        self.pending.discard(conn)
+
+        config = json.loads(config_data.decode('utf-8'))
+
+        # 判断客户端类型
+        if config.get('type') == 'list':
+            # 查询发送端列表
+            self.handle_list(conn)
+            return
+
+        if 'fps' in config:
+            # 发送端
+            client_id = f"{conn.address[0]}:{conn.address[1]}"
+            self.handle_sender(conn, client_id, config)
+        else:
+            # 接收端
+            sender_id = str(config.get('sender_id') or 'default')
+            if config.get('tiles'):
+                conn.codecs.add(CODEC_TILES)
+            if config.get('playback') is not None:
+                conn.role = 'playback'
+                conn.sender_id = sender_id
+            else:
+                self.handle_receiver(conn, sender_id)
+                self.select_tier(conn, config.get('tier') or DEFAULT_TIER)
+
+        if config.get('protocol', 1) >= PROTOCOL_VERSION:
+            self.accept_protocol(conn, config)
+
+        # 协议确定之后才知道用哪种格式发
+        if conn.role == 'receiver':
+            self.send_cached_keyframe(conn)
+        elif conn.role == 'playback':
+            self.start_playback(conn, float(config['playback']))
+
+    def accept_protocol(self, conn, config):
+        """协商版本 2：回复 accept（仍用长度前缀），之后双方改用帧头"""
+        codecs = [name for name in config.get('codecs', ['jpeg']) if name in CODECS]
+        if conn.role in ('receiver', 'playback'):
+            conn.codecs = {CODECS[name] for name in codecs} | {CODEC_JPEG}
+
+        self.send_control(conn, {
+            'type': 'accept',
+            'protocol': PROTOCOL_VERSION,
+            'codecs': codecs,
+            'sender_id': conn.sender_id,
+        })
+        conn.protocol = PROTOCOL_VERSION
+        conn.assembler.upgrade()
+
+    def select_tier(self, conn, tier):
+        """接收端选择的画质档位；服务器不能转码时收原始画面"""
+        if tier == DEFAULT_TIER:
+            return
+        if tier not in TIERS:
+            print(f"⚠️  未知的画质档位: {tier}，{conn.address} 收原始画面")
+            return
+
+        if self.transcoder is None:
+            try:
+                self.transcoder = Transcoder()
+            except ImportError as e:
+                print(f"⚠️  {e}，{conn.address} 收原始画面")
+                return
+            # 转码线程完成后唤醒事件循环
+            self.selector.register(self.transcoder.wake_socket, selectors.EVENT_READ, self.transcoder)
+
+        conn.tier = tier
+        print(f"   画质: {tier}")
+
+    def allocate_sender_id(self, requested, conn):
+        """为发送端分配 ID
+
+        同一台机器重连时接管原来的 ID（旧连接可能还没发现断开），
+        不同机器用了相同的 ID 时加上序号区分
+        """
+        info = self.senders.get(requested)
+        if info is None:
+            return requested
+
+        old = info['connection']
+        if old.address[0] == conn.address[0]:
+            print(f"♻️  {requested} 重新连接，关闭旧连接 {old.address}")
+            self.close_connection(old)
+            return requested
+
+        n = 2
+        while f"{requested}#{n}" in self.senders:
+            n += 1
+        sender_id = f"{requested}#{n}"
+        print(f"⚠️  ID {requested} 已被 {old.address} 使用，改用 {sender_id}")
+        return sender_id
+
+    def handle_sender(self, conn, client_id, config):
+        """注册发送端"""
+        # 没有 sender_id 的旧发送端使用 'default'，方便接收端连接
+        sender_id = self.allocate_sender_id(str(config.get('sender_id') or 'default'), conn)
+
+        print(f"📤 发送端: {conn.address} (协议 {config.get('protocol', 1)})")
+        print(f"   ID: {sender_id} ({client_id})")
         print(f"   区域: {config['region']}")
         print(f"   分辨率: {config['width']}x{config['height']}")
         print(f"   帧率: {config['fps']} FPS")
-        
-        # 使用 'default' 作为默认 ID，方便接收端连接
-        sender_id = 'default'
-        
+
+        conn.role = 'sender'
+        conn.sender_id = sender_id
+        conn.wants_feedback = bool(config.get('feedback'))
+
+        # 转发时直接用这个集合，不用每帧查表
+        with self.receiver_lock:
+            conn.subscribers = self.receivers.setdefault(sender_id, set())
+
         with self.sender_lock:
             self.senders[sender_id] = {
-                'socket': client_socket,
-                'address': client_address,
+                'connection': conn,
+                'address': conn.address,
                 'config': config,
                 'stats': {'frames': 0, 'bytes': 0},
+                # 发送端的截图、压缩耗时，以及从压缩完成到到达服务器的时间（需要两端时钟同步）
+                'timings': StageTimer(('capture', 'encode', 'uplink')),
                 'client_id': client_id
             }
-        
+
+    def handle_frame(self, conn, frame_data):
+        """处理发送端发来的一帧"""
+        sender_id = conn.sender_id
+        frame_size = len(frame_data)
+        arrived = time.monotonic()
+
+        view = memoryview(frame_data)
+        stage_times = None
+        if conn.protocol >= PROTOCOL_VERSION:
+            header = conn.assembler.frame_header
+            if header.codec == CODEC_JSON:
+                # 发送端目前没有控制消息
+                return
+            # 截图、压缩耗时原样转发给版本 2 的接收端，旧版接收端只收到图像数据
+            media = view
+            if header.flags & FLAG_STAGE_TIMES:
+                stage_times = STAGE_TIMES.unpack_from(view)
+                media = view[STAGE_TIMES.size:]
+        else:
+            # 旧版发送端：由服务器补上编码、序号和时刻
+            codec = CODEC_TILES if is_delta(view) else CODEC_JPEG
+            conn.seq = (conn.seq + 1) & 0xFFFFFFFF
+            header = FrameHeader(codec, FLAG_KEYFRAME if codec == CODEC_JPEG else 0,
+                                 conn.seq, time.time(), frame_size)
+            media = view
+
+        # 更新统计
+        with self.sender_lock:
+            info = self.senders.get(sender_id)
+            if info and info['connection'] is conn:
+                info['stats']['frames'] += 1
+                info['stats']['bytes'] += frame_size
+                if stage_times:
+                    capture_time, encode_time = stage_times
+                    timings = info['timings']
+                    timings.record('capture', capture_time)
+                    timings.record('encode', encode_time)
+                    timings.record('uplink', time.time() - header.timestamp - capture_time - encode_time)
+
+        self.stats['total_frames'] += 1
+        self.stats['total_bytes'] += frame_size
+
+        # 转发给订阅这个发送端的接收端
+        self.broadcast_frame(sender_id, conn.subscribers, header, view, media, arrived)
+
+        if self.recorder:
+            self.recorder.record(sender_id, header, view)
+
+        if conn.wants_feedback:
+            self.send_feedback(conn)
+
+    def handle_receiver(self, conn, sender_id):
+        """注册接收端"""
+        print(f"📥 接收端: {conn.address} (订阅: {sender_id})")
+
+        conn.role = 'receiver'
+        conn.sender_id = sender_id
+
+        with self.receiver_lock:
+            self.receivers.setdefault(sender_id, set()).add(conn)
+
+        if self.upstream and sender_id not in self.senders and sender_id not in self.retries:
+            self.connect_upstream(sender_id)
+
+    def connect_upstream(self, sender_id):
+        """中继：以接收端身份向上级服务器订阅 sender_id（非阻塞连接，握手在连上后发出）"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex(self.upstream)
+        if error not in CONNECT_IN_PROGRESS:
+            sock.close()
+            print(f"❌ 连接上级服务器失败 {self.upstream}: {errno.errorcode.get(error, error)}")
+            self.schedule_upstream_retry(sender_id)
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn = Connection(sock, self.upstream, self.queue_size)
+        conn.role = 'upstream'
+        conn.sender_id = sender_id
+        with self.receiver_lock:
+            conn.subscribers = self.receivers.setdefault(sender_id, set())
+        with self.sender_lock:
+            self.senders[sender_id] = {
+                'connection': conn,
+                'address': conn.address,
+                'config': {'relay': True},
+                'stats': {'frames': 0, 'bytes': 0},
+                'timings': StageTimer(('capture', 'encode', 'uplink')),
+                'client_id': f"上级 {self.upstream[0]}:{self.upstream[1]}"
+            }
+        self.upstreams[sender_id] = conn
+
+        config = {
+            'sender_id': sender_id,
+            'protocol': PROTOCOL_VERSION,
+            'codecs': sorted(CODECS),
+            'tiles': True,
+        }
+        payload = json.dumps(config).encode('utf-8')
+        conn.queue_message((pack_length(len(payload)), payload))
+        # 连上（或失败）时套接字变为可写，由 flush 发出握手
+        conn.writing = True
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        print(f"🔗 向上级服务器 {self.upstream[0]}:{self.upstream[1]} 订阅: {sender_id}")
+
+    def handle_upstream(self, conn, message):
+        """中继：上级服务器发来的消息"""
+        if conn.protocol < PROTOCOL_VERSION:
+            # 上级的 accept；旧版上级没有 accept，直接发帧（JPEG 和差分帧不会以 '{' 开头）
+            if message[:1] == b'{':
+                accept = json.loads(bytes(message).decode('utf-8'))
+                if accept.get('type') == 'accept' and accept.get('protocol', 1) >= PROTOCOL_VERSION:
+                    conn.protocol = PROTOCOL_VERSION
+                    conn.assembler.upgrade()
+                return
+        elif conn.assembler.frame_header.codec == CODEC_JSON:
+            return
+
+        # 收到画面才算连接正常，下次断开从最短的退避时间开始
+        self.retries.pop(conn.sender_id, None)
+        self.handle_frame(conn, message)
+
+    def schedule_upstream_retry(self, sender_id):
+        """本地还有接收端时，按退避时间安排重连"""
+        if not self.running or not self.receivers.get(sender_id) or sender_id in self.senders:
+            self.retries.pop(sender_id, None)
+            return
+        _, delay = self.retries.get(sender_id, (0, UPSTREAM_RETRY_MIN / 2))
+        delay = min(delay * 2, UPSTREAM_RETRY_MAX)
+        self.retries[sender_id] = (time.monotonic() + delay, delay)
+        print(f"⏳ {delay:.1f} 秒后重新向上级订阅: {sender_id}")
+
+    def check_upstream_retries(self):
+        now = time.monotonic()
+        for sender_id, (due, _) in list(self.retries.items()):
+            if now < due:
+                continue
+            if not self.receivers.get(sender_id) or sender_id in self.senders:
+                # 接收端都走了，或者发送端直接连到了本服务器
+                del self.retries[sender_id]
+            else:
+                self.connect_upstream(sender_id)
+
+    def handle_report(self, conn, message):
+        """接收端报告的各阶段耗时"""
+        if conn.protocol >= PROTOCOL_VERSION and conn.assembler.frame_header.codec != CODEC_JSON:
+            return
+        report = json.loads(bytes(message).decode('utf-8'))
+        if report.get('type') == 'stats':
+            conn.report = report.get('stages', {})
+
+    def handle_list(self, conn):
+        """返回当前所有发送端的信息，发送完后关闭连接"""
+        conn.role = 'list'
+        conn.close_when_flushed = True
+        self.send_control(conn, {'senders': self.sender_list()})
+
+    def sender_list(self):
+        """当前所有发送端的信息（列表请求的内容）"""
+        with self.sender_lock:
+            return [
+                {
+                    'sender_id': sender_id,
+                    'address': f"{info['address'][0]}:{info['address'][1]}",
+                    'width': info['config'].get('width'),
+                    'height': info['config'].get('height'),
+                    'fps': info['config'].get('fps'),
+                    'frames': info['stats']['frames'],
+                    'receivers': len(info['connection'].subscribers),
+                }
+                for sender_id, info in self.senders.items()
+            ]
+
+    def send_control(self, conn, message):
+        """按连接的协议发送一条 JSON 控制消息（不会被丢弃）"""
+        payload = json.dumps(message).encode('utf-8')
+        if conn.protocol >= PROTOCOL_VERSION:
+            header = pack_header(CODEC_JSON, 0, 0, 0.0, len(payload))
+        else:
+            header = pack_length(len(payload))
+        conn.queue_message((header, payload))
+        if not conn.writing:
+            self.flush(conn)
+
+    def broadcast_frame(self, sender_id, receivers, header, body, media, arrived=None):
+        """广播帧数据给一组接收端，关键帧同时存入缓存
+
+        版本 2 的接收端收到帧头 + body（可能带耗时前缀），旧版接收端收到长度 + media（图像数据）
+        """
+        # 所有接收端共享同一个头部和同一块帧数据
+        framed = (pack_header(header.codec, header.flags, header.seq, header.timestamp, len(body)), body)
+        legacy = (pack_length(len(media)), media)
+
+        if header.codec == CODEC_JPEG:
+            # 帧数据每条消息单独分配，之后不会被改写，可以直接缓存
+            self.keyframes.put(sender_id, framed, legacy, len(body))
+
+        # 接收端集合只在事件循环线程中修改，这里不需要加锁
+        if not receivers:
+            return
+
+        # 每个接收端有自己的有界队列，慢的接收端只会丢自己的旧帧，
+        # 不会拖慢发送端和其他接收端；发送出错时 flush 会把连接从集合中移除，所以先复制一份
+        tiers = set()
+        for conn in tuple(receivers):
+            if conn.tier != DEFAULT_TIER:
+                # 选择了缩小档位的接收端等转码结果
+                tiers.add(conn.tier)
+                continue
+            if header.codec not in conn.codecs:
+                continue
+            conn.queue_frame(framed if conn.protocol >= PROTOCOL_VERSION else legacy, arrived,
+                             header.codec == CODEC_JPEG)
+            if not conn.writing:
+                self.flush(conn)
+
+        # 只为有接收端的档位转码
+        if tiers:
+            self.transcoder.submit(sender_id, header, body, media, tiers, arrived)
+
+    def deliver_renditions(self):
+        """把转码完成的画面发给选择了对应档位的接收端"""
+        for sender_id, tier, header, prefix, jpeg, arrived in self.transcoder.collect():
+            framed, legacy = self.rendition_chunks(header, prefix, jpeg)
+            for conn in tuple(self.receivers.get(sender_id, ())):
+                if conn.tier != tier:
+                    continue
+                conn.queue_frame(framed if conn.protocol >= PROTOCOL_VERSION else legacy, arrived)
+                if not conn.writing:
+                    self.flush(conn)
+
+    def rendition_chunks(self, header, prefix, jpeg):
+        """转码后的画面作为关键帧发送，序号、时刻和耗时前缀沿用原始帧；返回 (版本 2 数据块, 旧版数据块)"""
+        flags = FLAG_KEYFRAME | (header.flags & FLAG_STAGE_TIMES)
+        body = (prefix, jpeg) if prefix else (jpeg,)
+        framed = (pack_header(CODEC_JPEG, flags, header.seq, header.timestamp, len(prefix) + len(jpeg)),) + body
+        return framed, (pack_length(len(jpeg)), jpeg)
+
+    def send_cached_keyframe(self, conn):
+        """把订阅的发送端最近的关键帧发给刚连上的接收端"""
+        cached = self.keyframes.get(conn.sender_id)
+        if conn.tier != DEFAULT_TIER:
+            self.send_cached_rendition(conn, cached)
+            return
+        if cached is None:
+            return
+        framed, legacy = cached
+        conn.queue_frame(framed if conn.protocol >= PROTOCOL_VERSION else legacy, time.monotonic())
+        if not conn.writing:
+            self.flush(conn)
+
+    def send_cached_rendition(self, conn, cached):
+        """选择了缩小档位的接收端：有这个档位最新一帧的转码结果就直接发，否则安排转码"""
+        seed = None
+        if cached is not None:
+            # 转码器还没有这个发送端的画面时，从缓存的关键帧开始
+            framed, legacy = cached
+            seed = (unpack_header(framed[0]), framed[1], legacy[1])
+        rendition = self.transcoder.request(conn.sender_id, conn.tier, seed)
+        if rendition is None:
+            return
+        framed, legacy = self.rendition_chunks(*rendition)
+        conn.queue_frame(framed if conn.protocol >= PROTOCOL_VERSION else legacy, time.monotonic())
+        if not conn.writing:
+            self.flush(conn)
+
+    def start_playback(self, conn, start):
+        """回放连接不参与转发：交给单独的线程用阻塞套接字发送
+
+        之后事件循环把它当作已关闭的连接，不再读写，套接字由回放线程关闭
+        """
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))
+        print(f"📼 回放: {conn.address} ({conn.sender_id} 从 {started} 开始)")
+
+        if self.recorder is None:
+            print("⚠️  服务器没有开启录制")
+            conn.close_when_flushed = True
+            self.flush(conn)
+            return
+
         try:
-            while self.running:
-                # 接收帧大小
-                size_data = self.recv_exact(client_socket, 4)
-                if not size_data:
-                    break
-                
-                frame_size = struct.unpack('!I', size_data)[0]
-                
-                # 接收帧数据
-                frame_data = self.recv_exact(client_socket, frame_size)
-                if not frame_data:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.closed = True
+        conn.sock.setblocking(True)
+        threading.Thread(target=self.playback_loop, args=(conn, start), daemon=True).start()
+
+    def playback_loop(self, conn, start):
+        """回放线程：按录制时的间隔发送 start 之后的帧，录制的末尾关闭连接"""
+        sock = conn.sock
+        count = 0
+        try:
+            # 握手回复可能还没发完
+            if conn.outbuf:
+                send_all(sock, list(conn.outbuf))
+                conn.outbuf.clear()
+
+            previous = start
+            for header, body in Archive(self.recorder.directory).frames(conn.sender_id, start):
+                if not self.running:
                     break
-                
-                # 更新统计
-                sender_id = 'default'
-                with self.sender_lock:
-                    if sender_id in self.senders:
-                        self.senders[sender_id]['stats']['frames'] += 1
-                        self.senders[sender_id]['stats']['bytes'] += frame_size
-                
-                self.stats['total_frames'] += 1
-                self.stats['total_bytes'] += frame_size
-                
-                # 转发给所有接收端
-                self.broadcast_frame(sender_id, frame_data)
-        
-        except Exception as e:
-            print(f"\n❌ 发送端断开 {client_address}: {e}")
-        
+                if header.codec not in conn.codecs:
+                    continue
+
+                # start 之前的帧（从最近的关键帧开始）直接发，之后按录制时的间隔
+                if header.timestamp > previous:
+                    time.sleep(min(header.timestamp - previous, PLAYBACK_MAX_GAP))
+                    previous = header.timestamp
+
+                # 录制时的截图、压缩耗时对回放没有意义，帧头的时刻改为发送时刻
+                media = body[STAGE_TIMES.size:] if header.flags & FLAG_STAGE_TIMES else body
+                if conn.protocol >= PROTOCOL_VERSION:
+                    flags = header.flags & ~FLAG_STAGE_TIMES
+                    framed = pack_header(header.codec, flags, header.seq, time.time(), len(media))
+                else:
+                    framed = pack_length(len(media))
+                send_all(sock, (framed, media))
+                count += 1
+
+            print(f"📼 回放结束: {conn.address} ({count} 帧)")
+
+            # 先告诉接收端数据发完了，等它关闭连接；直接关闭时如果还有没读的统计报告，
+            # 接收端会收到 RST，可能丢掉最后几帧
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(PLAYBACK_MAX_GAP)
+            while sock.recv(4096):
+                pass
+
+        except OSError as e:
+            print(f"🔌 回放中断 {conn.address}: {e}")
+
         finally:
-            sender_id = 'default'
-            with self.sender_lock:
-                if sender_id in self.senders:
-                    del self.senders[sender_id]
-            
-            client_socket.close()
-            print(f"🔌 发送端断开: {client_address}")
-    
-    def handle_receiver(self, client_socket, client_address, sender_id):
-        """处理接收端"""
-        print(f"📥 接收端: {client_address} (订阅: {sender_id})")
-        
-        with self.receiver_lock:
-            if sender_id not in self.receivers:
-                self.receivers[sender_id] = []
-            self.receivers[sender_id].append(client_socket)
-        
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def send_feedback(self, conn):
+        """告诉发送端接收端的拥塞情况（限制频率）"""
+        now = time.monotonic()
+        # 上一条反馈还没发出去时不再堆积
+        if now - conn.last_feedback < FEEDBACK_INTERVAL or conn.outbuf:
+            return
+        conn.last_feedback = now
+
+        queue = 0
+        dropped = 0
+        for receiver in conn.subscribers:
+            queue = max(queue, len(receiver.frames))
+            dropped += receiver.stats['dropped']
+
+        # 接收端断开后总数可能变小，只报告新增的部分
+        new_dropped = max(dropped - conn.reported_dropped, 0)
+        conn.reported_dropped = dropped
+
+        self.send_control(conn, {
+            'type': 'feedback',
+            'queue': queue,
+            'dropped': new_dropped,
+            'receivers': len(conn.subscribers),
+        })
+
+    def flush(self, conn):
+        """尽量把写队列中的数据发出去，发不完时等待可写事件"""
+        outbuf = conn.outbuf
+
         try:
-            # 保持连接
-            while self.running:
-                time.sleep(1)
-        
-        except Exception as e:
-            print(f"\n❌ 接收端断开 {client_address}: {e}")
-        
-        finally:
+            while True:
+                # 一次只取一帧，还在队列里的帧仍然可以被更新的帧替换
+                if not outbuf:
+                    if not conn.frames:
+                        break
+                    chunks, conn.frame_arrived, _ = conn.frames.popleft()
+                    outbuf.extend(chunks)
+                    conn.stats['frames'] += 1
+
+                # 长度头和帧数据用一次 sendmsg 写出
+                sent = send_chunks(conn.sock, outbuf)
+                consume(outbuf, sent)
+                if outbuf:
+                    # 套接字缓冲区已满
+                    break
+
+                # 一帧发完：记录它在服务器上停留的时间
+                if conn.frame_arrived is not None:
+                    conn.queue_times.record(time.monotonic() - conn.frame_arrived)
+                    conn.frame_arrived = None
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.close_connection(conn, e)
+            return
+
+        # 只有还有数据没发完时才关注可写事件
+        writing = conn.has_output()
+        if not writing and conn.close_when_flushed:
+            self.close_connection(conn)
+            return
+        if writing != conn.writing:
+            conn.writing = writing
+            events = selectors.EVENT_READ
+            if writing:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(conn.sock, events, conn)
+
+    def close_connection(self, conn, error=None):
+        """关闭连接并从发送端/接收端列表中移除"""
+        if conn.closed:
+            return
+        conn.closed = True
+
+        self.pending.discard(conn)
+
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+        if conn.role in ('sender', 'upstream'):
+            with self.sender_lock:
+                info = self.senders.get(conn.sender_id)
+                if info and info['connection'] is conn:
+                    del self.senders[conn.sender_id]
+                    removed = True
+                else:
+                    removed = False
+
+            # 没有接收端在等待时清理索引项
+            if removed:
+                with self.receiver_lock:
+                    if not self.receivers.get(conn.sender_id, True):
+                        del self.receivers[conn.sender_id]
+
+            if removed and self.transcoder is not None:
+                self.transcoder.discard(conn.sender_id)
+
+            if conn.role == 'upstream':
+                if self.upstreams.get(conn.sender_id) is conn:
+                    del self.upstreams[conn.sender_id]
+                print(f"🔌 上级订阅断开: {conn.sender_id}" + (f" ({error})" if error else ""))
+                self.schedule_upstream_retry(conn.sender_id)
+            else:
+                if error:
+                    print(f"\n❌ 发送端断开 {conn.address}: {error}")
+                print(f"🔌 发送端断开: {conn.address}")
+
+        elif conn.role == 'receiver':
             with self.receiver_lock:
-                if sender_id in self.receivers:
-                    if client_socket in self.receivers[sender_id]:
-                        self.receivers[sender_id].remove(client_socket)
-                    
-                    if not self.receivers[sender_id]:
-                        del self.receivers[sender_id]
-            
-            client_socket.close()
-            print(f"🔌 接收端断开: {client_address}")
-    
-    def broadcast_frame(self, sender_id, frame_data):
-        """广播帧数据给所有接收端"""
-        with self.receiver_lock:
-            if sender_id not in self.receivers:
-                return
-            
-            frame_size = len(frame_data)
-            size_data = struct.pack('!I', frame_size)
-            
-            dead_receivers = []
-            
-            for receiver_socket in self.receivers[sender_id]:
-                try:
-                    receiver_socket.sendall(size_data)
-                    receiver_socket.sendall(frame_data)
-                except:
-                    dead_receivers.append(receiver_socket)
-            
-            # 移除断开的接收端
-            for receiver_socket in dead_receivers:
-                self.receivers[sender_id].remove(receiver_socket)
-                try:
-                    receiver_socket.close()
-                except:
-                    pass
-    
-    def recv_exact(self, sock, size):
-        """接收指定大小的数据"""
-        data = b''
-        while len(data) < size:
-            chunk = sock.recv(size - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        return data
-    
+                receivers = self.receivers.get(conn.sender_id)
+                if receivers is not None:
+                    receivers.discard(conn)
+
+                    # 发送端还在时保留空集合，它的 subscribers 引用的就是这个集合
+                    if not receivers and conn.sender_id not in self.senders:
+                        del self.receivers[conn.sender_id]
+
+            # 中继：本地没有接收端了，不再占用上级的带宽
+            upstream = self.upstreams.get(conn.sender_id)
+            if upstream is not None and not upstream.subscribers:
+                self.close_connection(upstream)
+
+            if error:
+                print(f"\n❌ 接收端断开 {conn.address}: {error}")
+            print(f"🔌 接收端断开: {conn.address}")
+
+        elif error:
+            print(f"❌ 处理客户端失败 {conn.address}: {error}")
+
     def print_stats_loop(self):
         """定期打印统计信息"""
         while self.running:
             time.sleep(5)
             self.print_stats()
-    
+
     def print_stats(self):
         """打印统计信息"""
         if not self.stats['start_time']:
             return
-        
+
         elapsed = time.time() - self.stats['start_time']
-        
+
         print("\n" + "=" * 60)
         print("📊 服务器统计")
         print("=" * 60)
-        
+
         with self.sender_lock:
             print(f"发送端数量: {len(self.senders)}")
             for sender_id, info in self.senders.items():
@@ -267,64 +989,185 @@ class ScreenServer:
                 print(f"  [{sender_id}] {info.get('client_id', 'N/A')}")
                 print(f"    帧数: {stats['frames']}")
                 print(f"    数据: {stats['bytes'] / 1024 / 1024:.2f} MB")
-        
+
         with self.receiver_lock:
             total_receivers = sum(len(receivers) for receivers in self.receivers.values())
             print(f"接收端数量: {total_receivers}")
-        
+            for sender_id, receivers in self.receivers.items():
+                for conn in receivers:
+                    stats = conn.stats
+                    print(f"  [{sender_id}] {conn.address[0]}:{conn.address[1]} "
+                          f"已发送: {stats['frames']} 帧 | "
+                          f"排队: {len(conn.frames)} | "
+                          f"丢弃: {stats['dropped']}")
+
         print(f"\n总帧数: {self.stats['total_frames']}")
         print(f"总数据: {self.stats['total_bytes'] / 1024 / 1024:.2f} MB")
-        
+
         if elapsed > 0:
             print(f"平均 FPS: {self.stats['total_frames'] / elapsed:.1f}")
             print(f"平均速率: {(self.stats['total_bytes'] * 8 / 1024 / 1024) / elapsed:.2f} Mbps")
-        
+
         print("=" * 60)
-    
+
+    def start_stats_http(self):
+        """在本机端口上提供 JSON 统计接口"""
+        if not self.stats_port:
+            return
+        try:
+            self.stats_http = HTTPServer(('127.0.0.1', self.stats_port), StatsHandler)
+        except OSError as e:
+            print(f"⚠️  统计接口启动失败: {e}")
+            return
+        self.stats_http.screen_server = self
+        threading.Thread(target=self.stats_http.serve_forever, daemon=True).start()
+        print(f"📈 统计接口: http://127.0.0.1:{self.stats_port}/stats\n")
+
+    def stats_snapshot(self):
+        """各发送端、接收端的统计和各阶段耗时分位数（毫秒）"""
+        elapsed = time.time() - self.stats['start_time'] if self.stats['start_time'] else 0
+        snapshot = {
+            'uptime': round(elapsed, 1),
+            'total_frames': self.stats['total_frames'],
+            'total_bytes': self.stats['total_bytes'],
+            'keyframe_cache': {'frames': len(self.keyframes.entries), 'bytes': self.keyframes.size},
+            'recorder': dict(self.recorder.stats) if self.recorder else None,
+            'transcoder': dict(self.transcoder.stats) if self.transcoder else None,
+            'senders': {},
+        }
+
+        with self.sender_lock:
+            senders = [(sender_id, info['address'], dict(info['stats']), info['timings'])
+                       for sender_id, info in self.senders.items()]
+        with self.receiver_lock:
+            receivers = {sender_id: list(conns) for sender_id, conns in self.receivers.items()}
+
+        for sender_id, address, stats, timings in senders:
+            # 所有接收端合并后的耗时
+            merged = {'server_queue': Histogram()}
+            receiver_list = []
+
+            for conn in receivers.get(sender_id, ()):
+                stages = {'server_queue': conn.queue_times}
+                for stage, data in conn.report.items():
+                    stages[stage] = Histogram.from_dict(data)
+                for stage, histogram in stages.items():
+                    merged.setdefault(stage, Histogram()).merge(histogram)
+
+                receiver_list.append({
+                    'address': f"{conn.address[0]}:{conn.address[1]}",
+                    'protocol': conn.protocol,
+                    'tier': conn.tier,
+                    'frames': conn.stats['frames'],
+                    'dropped': conn.stats['dropped'],
+                    'queued': len(conn.frames),
+                    'stages': {stage: h.summary() for stage, h in stages.items()},
+                })
+
+            stages = timings.summary()
+            stages.update((stage, h.summary()) for stage, h in merged.items())
+            snapshot['senders'][sender_id] = {
+                'address': f"{address[0]}:{address[1]}",
+                'frames': stats['frames'],
+                'bytes': stats['bytes'],
+                'stages': stages,
+                'receivers': receiver_list,
+            }
+
+        return snapshot
+
     def stop(self):
         """停止服务器"""
+        if self.server_socket is None and self.selector is None:
+            return
         self.running = False
-        
+
+        if self.recorder is not None:
+            self.recorder.stop()
+
+        if self.stats_http is not None:
+            self.stats_http.shutdown()
+            self.stats_http.server_close()
+            self.stats_http = None
+
         # 关闭所有连接
         with self.sender_lock:
-            for info in self.senders.values():
-                try:
-                    info['socket'].close()
-                except:
-                    pass
+            senders = [info['connection'] for info in self.senders.values()]
+        with self.receiver_lock:
+            receivers = [conn for conns in self.receivers.values() for conn in conns]
+
+        for conn in senders + receivers + list(self.pending):
+            self.close_connection(conn)
+
+        with self.sender_lock:
             self.senders.clear()
-        
         with self.receiver_lock:
-            for receivers in self.receivers.values():
-                for receiver_socket in receivers:
-                    try:
-                        receiver_socket.close()
-                    except:
-                        pass
             self.receivers.clear()
-        
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
-        
+
+        try:
+            self.server_socket.close()
+        except:
+            pass
+        self.server_socket = None
+
+        if self.transcoder is not None:
+            self.transcoder.close()
+            self.transcoder = None
+
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+
         print("\n✅ 服务器已停止")
 
 
+class StatsHandler(BaseHTTPRequestHandler):
+    """GET /stats 返回 ScreenServer.stats_snapshot()"""
+
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') not in ('', '/stats'):
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.screen_server.stats_snapshot(),
+                          ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不打印每个请求
+        pass
+
+
 if __name__ == "__main__":
     import sys
-    
+
     # 默认参数
     host = '0.0.0.0'
     port = 5003
-    
-    # 解析命令行参数
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
-    
-    server = ScreenServer(host, port)
-    
+    stats_port = STATS_PORT
+    upstream = None
+
+    # 解析命令行参数；--upstream <主机:端口> 作为中继运行
+    args = sys.argv[1:]
+    if '--upstream' in args:
+        index = args.index('--upstream')
+        upstream_host, _, upstream_port = args[index + 1].rpartition(':')
+        upstream = (upstream_host, int(upstream_port))
+        del args[index:index + 2]
+    if len(args) > 0:
+        port = int(args[0])
+    if len(args) > 1:
+        stats_port = int(args[1])
+    # 第三个参数是录制目录，不指定时不录制
+    record_dir = args[2] if len(args) > 2 else None
+
+    server = ScreenServer(host, port, stats_port=stats_port, record_dir=record_dir,
+                          upstream=upstream)
+
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,363 @@
+"""
+屏幕同步 - 多进程服务器（仅 Linux）
+
+单个 ScreenServer 的转发都在一个进程里，受 GIL 限制最多用满一个核。
+这里由接入进程接受连接、读取配置信息，再把套接字转交给 N 个工作进程之一：
+
+    接入进程 --（管道 + send_handle）--> 工作进程 1..N（各自是一个 ScreenServer）
+
+按 sender_id 的一致性哈希选择工作进程，订阅同一个发送端的接收端和发送端在同一个进程，
+转发完全在工作进程内完成；增减工作进程时只有少部分发送端换进程。
+列表请求由接入进程向所有工作进程查询后汇总（请求带序号，过期的回复直接丢弃；
+等待回复时接入循环照常运行）。
+每个工作进程的统计接口在 统计端口 + 1 + 序号 上
+"""
+
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import selectors
+import socket
+import time
+from multiprocessing import reduction
+
+from framing import send_message
+from server import HANDSHAKE_TIMEOUT, STATS_PORT, Connection, ScreenServer
+
+
+# 每个工作进程在哈希环上的虚拟节点数，越多分布越均匀
+VIRTUAL_NODES = 64
+# 等待工作进程回复列表请求的时间（秒），超时的工作进程不计入列表
+LIST_TIMEOUT = 1.0
+
+
+def hash_key(key):
+    """稳定的哈希（内置 hash() 每个进程不同）"""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def route_key(sender_id):
+    """路由用的 ID：服务器给重名发送端加的 '#序号' 不参与路由，保证分到同一个进程"""
+    return re.sub(r'#\d+$', '', sender_id)
+
+
+class HashRing:
+    """一致性哈希环"""
+
+    def __init__(self, nodes, replicas=VIRTUAL_NODES):
+        points = sorted((hash_key(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.keys = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def lookup(self, key):
+        index = bisect.bisect(self.keys, hash_key(key)) % len(self.keys)
+        return self.nodes[index]
+
+
+class ShardWorker(ScreenServer):
+    """工作进程：不监听端口，连接由接入进程通过管道转交"""
+
+    def __init__(self, index, pipe, **kwargs):
+        super().__init__(**kwargs)
+        self.index = index
+        self.pipe = pipe
+
+    def listen(self):
+        # 管道可读就是有新连接（或列表请求）
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.pipe, selectors.EVENT_READ, None)
+        print(f"✅ 工作进程 {self.index} 启动 (pid {os.getpid()})")
+
+    def accept_connections(self):
+        """处理接入进程发来的消息"""
+        try:
+            while self.pipe.poll():
+                message = self.pipe.recv()
+                if message[0] == 'connection':
+                    _, address, config_data = message
+                    fd = reduction.recv_handle(self.pipe)
+                    self.adopt(socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=fd),
+                               address, config_data)
+                elif message[0] == 'list':
+                    # 回复带上请求的序号，接入进程据此丢弃超时后才到的回复
+                    self.pipe.send(('senders', message[1], self.sender_list()))
+        except (EOFError, OSError):
+            # 接入进程已退出
+            self.running = False
+
+    def adopt(self, client_socket, address, config_data):
+        """接手一个已经读完配置信息的连接"""
+        conn = self.add_connection(client_socket, address)
+        try:
+            self.handle_message(conn, config_data)
+        except Exception as e:
+            self.close_connection(conn, e)
+
+
+def run_worker(index, pipe, stats_port, record_dir):
+    """工作进程入口"""
+    worker = ShardWorker(index, pipe, stats_port=stats_port, record_dir=record_dir)
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardedServer:
+    """接入进程：接受连接，读取配置信息后按 sender_id 转交给工作进程"""
+
+    def __init__(self, host='0.0.0.0', port=5003, workers=None, stats_port=STATS_PORT,
+                 record_dir=None):
+        self.host = host
+        self.port = port
+        self.worker_count = workers or os.cpu_count() or 1
+        self.stats_port = stats_port
+        self.record_dir = record_dir
+        self.workers = []  # [(process, pipe)]
+        self.ring = HashRing(range(self.worker_count))
+        self.running = False
+        self.server_socket = None
+        self.selector = None
+
+        # 尚未完成握手的连接
+        self.pending = set()
+
+        # 等待工作进程回复的列表请求: {序号: {'conn', 'waiting', 'senders', 'deadline'}}
+        self.lists = {}
+        self.list_id = 0
+
+        self.stats = {'connections': [0] * self.worker_count, 'lists': 0}
+
+    def start(self):
+        """启动工作进程和接入循环"""
+        try:
+            # 用 spawn 启动工作进程：fork 会让每个进程继承其他管道的另一端，
+            # 接入进程退出时工作进程收不到 EOF
+            context = multiprocessing.get_context('spawn')
+            for index in range(self.worker_count):
+                parent, child = context.Pipe()
+                worker_stats = self.stats_port + 1 + index if self.stats_port else 0
+                process = context.Process(
+                    target=run_worker, args=(index, child, worker_stats, self.record_dir),
+                    daemon=True)
+                process.start()
+                child.close()
+                self.workers.append((process, parent))
+
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(128)
+            self.server_socket.setblocking(False)
+
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+            # 工作进程的管道（data 为工作进程序号），用于接收列表请求的回复
+            for index, (_, pipe) in enumerate(self.workers):
+                self.selector.register(pipe, selectors.EVENT_READ, index)
+            self.running = True
+
+            print("=" * 60)
+            print("屏幕同步服务器（多进程）")
+            print("=" * 60)
+            print(f"✅ 服务器启动: {self.host}:{self.port} ({self.worker_count} 个工作进程)")
+            print("💡 等待连接...\n")
+
+            self.event_loop()
+
+        except Exception as e:
+            print(f"❌ 服务器启动失败: {e}")
+
+        finally:
+            self.stop()
+
+    def event_loop(self):
+        while self.running:
+            # 有等待回复的列表请求时缩短超时，及时处理超时
+            for key, _ in self.selector.select(timeout=0.1 if self.lists else 1.0):
+                if key.data is None:
+                    self.accept_connections()
+                elif isinstance(key.data, int):
+                    self.on_worker_reply(key.data)
+                else:
+                    self.on_readable(key.data)
+
+            # 关闭迟迟不发送配置信息的连接
+            now = time.time()
+            for conn in list(self.pending):
+                if now - conn.connected_at > HANDSHAKE_TIMEOUT:
+                    print(f"⚠️  {conn.address} 未发送配置信息")
+                    self.drop(conn)
+
+            # 工作进程没有按时回复的列表请求，用已经收到的部分回复
+            deadline = time.monotonic()
+            for request_id, request in list(self.lists.items()):
+                if deadline >= request['deadline']:
+                    for index in sorted(request['waiting']):
+                        print(f"⚠️  工作进程 {index} 没有回复列表请求")
+                    self.finish_list(request_id)
+
+    def accept_connections(self):
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    print(f"❌ 接受连接失败: {e}")
+                return
+
+            client_socket.setblocking(False)
+            conn = Connection(client_socket, client_address)
+            self.pending.add(conn)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def on_readable(self, conn):
+        """读取配置信息；只读到配置为止，之后的数据留给工作进程"""
+        try:
+            message = conn.assembler.read_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            self.drop(conn)
+            return
+        if message is None:
+            return
+
+        self.pending.discard(conn)
+        self.selector.unregister(conn.sock)
+        try:
+            waiting = self.dispatch(conn, bytes(message))
+        except Exception as e:
+            print(f"❌ 处理客户端失败 {conn.address}: {e}")
+            waiting = False
+        if not waiting:
+            conn.sock.close()
+
+    def dispatch(self, conn, config_data):
+        """列表请求发给所有工作进程（返回 True，回复到齐后再关闭连接），其他连接转交给工作进程"""
+        config = json.loads(config_data.decode('utf-8'))
+
+        if config.get('type') == 'list':
+            self.request_list(conn)
+            return True
+
+        sender_id = str(config.get('sender_id') or 'default')
+        index = self.ring.lookup(route_key(sender_id))
+        process, pipe = self.workers[index]
+
+        # 工作进程收到的是套接字的副本，接入进程这边随后关闭
+        pipe.send(('connection', conn.address, config_data))
+        reduction.send_handle(pipe, conn.sock.fileno(), process.pid)
+        self.stats['connections'][index] += 1
+        print(f"🔀 {conn.address} ({sender_id}) -> 工作进程 {index}")
+
+    def request_list(self, conn):
+        """向所有工作进程查询发送端，不等待回复"""
+        self.list_id += 1
+        for _, pipe in self.workers:
+            pipe.send(('list', self.list_id))
+        self.lists[self.list_id] = {
+            'conn': conn,
+            'waiting': set(range(len(self.workers))),
+            'senders': [],
+            'deadline': time.monotonic() + LIST_TIMEOUT,
+        }
+        self.stats['lists'] += 1
+
+    def on_worker_reply(self, index):
+        """工作进程的回复；超时后才到的回复（序号已不在等待中）直接丢弃"""
+        _, pipe = self.workers[index]
+        try:
+            while pipe.poll():
+                kind, request_id, senders = pipe.recv()
+                request = self.lists.get(request_id)
+                if kind != 'senders' or request is None:
+                    continue
+                request['senders'].extend(senders)
+                request['waiting'].discard(index)
+                if not request['waiting']:
+                    self.finish_list(request_id)
+        except (EOFError, OSError):
+            print(f"❌ 工作进程 {index} 已退出")
+            self.selector.unregister(pipe)
+
+    def finish_list(self, request_id):
+        """回复列表请求并关闭连接"""
+        request = self.lists.pop(request_id)
+        conn = request['conn']
+        try:
+            # 列表很小，一般一次写完；客户端不读时最多等 LIST_TIMEOUT
+            conn.sock.settimeout(LIST_TIMEOUT)
+            send_message(conn.sock, json.dumps({'senders': request['senders']}).encode('utf-8'))
+        except OSError as e:
+            print(f"❌ 回复列表请求失败 {conn.address}: {e}")
+        finally:
+            conn.sock.close()
+
+    def drop(self, conn):
+        self.pending.discard(conn)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def stop(self):
+        """停止接入进程和所有工作进程"""
+        self.running = False
+
+        for conn in list(self.pending):
+            self.drop(conn)
+        for request in self.lists.values():
+            request['conn'].sock.close()
+        self.lists.clear()
+
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+        # 关闭管道后工作进程自己退出
+        for process, pipe in self.workers:
+            pipe.close()
+        for process, _ in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 默认参数
+    host = '0.0.0.0'
+    port = 5003
+    workers = None
+    stats_port = STATS_PORT
+    record_dir = None
+
+    # 解析命令行参数: [端口] [工作进程数] [统计端口] [录制目录]
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        workers = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        stats_port = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        record_dir = sys.argv[4]
+
+    server = ShardedServer(host, port, workers, stats_port, record_dir)
+
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("\n\n⏹️  停止服务器")
+        server.stop()
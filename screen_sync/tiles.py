@@ -0,0 +1,191 @@
+"""
+屏幕同步 - 分块差分编码
+把画面切成 TILE_SIZE 见方的块并对每块的像素做哈希，
+只发送与最近一个关键帧不同的块，并定期发送完整的关键帧
+
+    关键帧: 普通 JPEG（旧的接收端也能显示）
+    差分帧: b'TILE' + <块大小 u16><宽 u16><高 u16><块数 u16>
+            + 每块 <块序号 u16><JPEG 长度 u32><JPEG>
+
+差分帧总是相对于关键帧而不是上一帧：服务器会为慢的接收端丢帧，
+收到关键帧之后的任意一个差分帧都能合成出完整的画面（服务器不会丢掉差分帧所依赖的关键帧）。
+画面不变时不发送任何数据。
+"""
+
+import hashlib
+import io
+import struct
+import time
+
+from PIL import Image
+
+from framing import TILE_MAGIC, is_delta
+
+
+TILE_SIZE = 64
+DELTA_HEADER = struct.Struct('!HHHH')
+TILE_ENTRY = struct.Struct('!HI')
+# 关键帧间隔（秒），让中途加入的接收端能拿到完整画面
+KEYFRAME_INTERVAL = 10.0
+# 变化的块超过这个比例时，直接发关键帧更省
+KEYFRAME_RATIO = 0.5
+
+
+def encode_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def tile_boxes(width, height, tile_size):
+    """按行优先顺序列出所有块的区域"""
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+class TileEncoder:
+    """发送端：把截图编码为关键帧或差分帧"""
+
+    def __init__(self, quality=75, tile_size=TILE_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+        self.quality = quality
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+
+        self.size = None
+        self.boxes = []
+        # 最近一个关键帧每块的哈希
+        self.key_hashes = None
+        self.last_keyframe = 0.0
+        # 上一次发送的差分帧包含的块 {块序号: 哈希}
+        self.last_sent = None
+
+        self.stats = {'keyframes': 0, 'deltas': 0, 'skipped': 0}
+
+    def request_keyframe(self):
+        """下一帧发送关键帧（例如重连之后）"""
+        self.key_hashes = None
+
+    def hash_tiles(self, image):
+        return [hashlib.blake2b(image.crop(box).tobytes(), digest_size=16).digest()
+                for box in self.boxes]
+
+    def encode(self, image):
+        """编码一帧，返回要发送的数据；画面与上次发送的相同时返回 None"""
+        job = self.plan(image)
+        return None if job is None else self.render(job)
+
+    def plan(self, image):
+        """决定这一帧发关键帧、差分帧还是不发，必须按帧的顺序调用
+
+        返回 (image, tiles)：tiles 为 None 表示关键帧，否则是 [(块序号, 区域), ...]
+        """
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        if image.size != self.size:
+            self.size = image.size
+            self.boxes = tile_boxes(image.width, image.height, self.tile_size)
+            self.key_hashes = None
+
+        hashes = self.hash_tiles(image)
+        now = time.time()
+
+        if self.key_hashes is None or now - self.last_keyframe >= self.keyframe_interval:
+            return self.keyframe(image, hashes, now)
+
+        changed = {i: h for i, (h, key) in enumerate(zip(hashes, self.key_hashes)) if h != key}
+        if len(changed) > len(hashes) * KEYFRAME_RATIO:
+            return self.keyframe(image, hashes, now)
+
+        if changed == self.last_sent:
+            self.stats['skipped'] += 1
+            return None
+
+        self.last_sent = changed
+        self.stats['deltas'] += 1
+        return image, [(index, self.boxes[index]) for index in changed]
+
+    def keyframe(self, image, hashes, now):
+        self.key_hashes = hashes
+        self.last_keyframe = now
+        self.last_sent = {}
+        self.stats['keyframes'] += 1
+        return image, None
+
+    def render(self, job):
+        """把 plan() 的结果压缩为要发送的数据；不修改编码器状态，可以并行执行"""
+        image, tiles = job
+        if tiles is None:
+            return encode_jpeg(image, self.quality)
+
+        parts = [TILE_MAGIC, DELTA_HEADER.pack(self.tile_size, image.width, image.height, len(tiles))]
+        for index, box in tiles:
+            data = encode_jpeg(image.crop(box), self.quality)
+            parts.append(TILE_ENTRY.pack(index, len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+
+class TileCompositor:
+    """接收端：把差分帧中的块贴到关键帧的副本上
+
+    decode() 可以传入显示区域的大小，画面比显示区域大时 JPEG 用 draft()
+    直接按 1/2、1/4、1/8 解码，差分帧中的块按关键帧的比例缩小后再贴上去
+    （比例在关键帧时确定，窗口放大后要等下一个关键帧才恢复清晰）
+    """
+
+    def __init__(self):
+        self.keyframe = None
+        # 关键帧的原始尺寸和实际解码的比例
+        self.full_size = None
+        self.scale = 1.0
+
+    def reset(self):
+        self.keyframe = None
+
+    def decode(self, payload, view_size=None):
+        """解码一帧，返回完整画面；还没有收到关键帧时返回 None"""
+        if not is_delta(payload):
+            image = Image.open(io.BytesIO(payload))
+            self.full_size = image.size
+            if view_size:
+                scale = min(view_size[0] / image.width, view_size[1] / image.height)
+                if scale < 1.0:
+                    image.draft('RGB', (max(int(image.width * scale), 1),
+                                        max(int(image.height * scale), 1)))
+            self.keyframe = image.convert('RGB')
+            self.scale = self.keyframe.width / self.full_size[0]
+            return self.keyframe
+
+        if self.keyframe is None:
+            return None
+
+        tile_size, width, height, count = DELTA_HEADER.unpack_from(payload, len(TILE_MAGIC))
+        if self.full_size != (width, height):
+            # 分辨率变了，等下一个关键帧
+            return None
+
+        frame = self.keyframe.copy()
+        scale = self.scale
+        columns = -(-width // tile_size)
+        offset = len(TILE_MAGIC) + DELTA_HEADER.size
+
+        for _ in range(count):
+            index, size = TILE_ENTRY.unpack_from(payload, offset)
+            offset += TILE_ENTRY.size
+            tile = Image.open(io.BytesIO(payload[offset:offset + size]))
+            offset += size
+
+            x = (index % columns) * tile_size
+            y = (index // columns) * tile_size
+            if scale != 1.0:
+                expected = (max(round(tile.width * scale), 1), max(round(tile.height * scale), 1))
+                tile.draft('RGB', expected)
+                if tile.size != expected:
+                    tile = tile.resize(expected, Image.Resampling.BILINEAR)
+                x = round(x * scale)
+                y = round(y * scale)
+            frame.paste(tile, (x, y))
+
+        return frame
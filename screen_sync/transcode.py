@@ -0,0 +1,248 @@
+"""
+屏幕同步 - 服务器端转码（需要 Pillow）
+
+接收端在握手配置中用 "tier" 选择画质档位：
+    'full'（默认）原始帧，不转码 / 'medium' 最长边 960 / 'small' 最长边 480
+
+只有某个发送端有 medium/small 的订阅者时才转码，而且只生成有订阅者的档位：
+每帧解码一次（JPEG 用 draft() 直接按需要的最大档位解码，差分帧贴到关键帧上），
+再缩放、压缩成各个档位的 JPEG。之后加入了更大档位的订阅者时，用保存的原始关键帧
+按新的档位重新解码，再贴上最近的差分帧。转码在线程池中进行，同一发送端的帧按顺序处理，
+处理不过来时和接收端一样只保留最新的关键帧和差分帧。
+结果放进队列，通过 socketpair 唤醒服务器的事件循环发送；每个档位缓存最新一帧（按序号），
+新加入的接收端直接使用
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from framing import is_delta
+
+try:
+    from PIL import Image
+    from tiles import TileCompositor, encode_jpeg
+except ImportError:
+    Image = None
+
+
+DEFAULT_TIER = 'full'
+# 各档位画面的最长边（像素）和 JPEG 质量
+TIERS = {'medium': 960, 'small': 480}
+TIER_QUALITY = {'medium': 70, 'small': 60}
+# 转码线程数（Pillow 解码、缩放、压缩时释放 GIL）
+TRANSCODE_WORKERS = 2
+
+
+def fit(size, max_side):
+    """等比缩小到最长边不超过 max_side"""
+    scale = max_side / max(size)
+    if scale >= 1.0:
+        return size
+    return max(int(size[0] * scale), 1), max(int(size[1] * scale), 1)
+
+
+class SenderState:
+    """一个发送端的转码状态（字段由 Transcoder.lock 保护，compositor 只在处理线程中使用）"""
+
+    def __init__(self):
+        self.compositor = TileCompositor()
+        # 待处理的帧: (header, prefix, media, tiers, arrived)，关键帧和差分帧各一格
+        self.keyframe = None
+        self.delta = None
+        # 需要用当前画面补做的档位（新加入的接收端）
+        self.render = set()
+        self.running = False
+        # 最近一帧的画面和它的 (header, prefix, arrived)，是关键帧时还有原始 JPEG
+        self.image = None
+        self.source = None
+        self.original = None
+        # 当前关键帧和它之后最近一个差分帧的原始数据，更大的档位加入时用来重新解码
+        self.key_media = None
+        self.delta_media = None
+
+
+class Transcoder:
+    """按档位转码，结果通过 wake_socket 通知事件循环，由 collect() 取出"""
+
+    def __init__(self, workers=TRANSCODE_WORKERS):
+        if Image is None:
+            raise ImportError("服务器端转码需要 Pillow: pip install Pillow")
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.senders = {}  # {sender_id: SenderState}
+        # 每个档位最新的转码结果: {sender_id: (seq, {tier: jpeg})}
+        self.cache = {}
+        # 转码完成的结果: (sender_id, tier, header, prefix, jpeg, arrived)
+        self.done = deque()
+
+        # 事件循环监听 wake_socket，处理线程往另一端写一个字节
+        self.wake_socket, self.notify_socket = socket.socketpair()
+        self.wake_socket.setblocking(False)
+        self.notify_socket.setblocking(False)
+
+        self.stats = {'frames': 0, 'renditions': 0, 'reused': 0, 'skipped': 0, 'redecoded': 0}
+
+    def submit(self, sender_id, header, body, media, tiers, arrived=None):
+        """事件循环转发一帧时调用；tiers 是有订阅者的档位，arrived 是帧到达服务器的时刻"""
+        prefix = bytes(body[:len(body) - len(media)])
+        item = (header, prefix, media, frozenset(tiers), arrived)
+        with self.lock:
+            state = self.senders.get(sender_id)
+            if state is None:
+                state = self.senders[sender_id] = SenderState()
+
+            if is_delta(media):
+                if state.delta is not None:
+                    self.stats['skipped'] += 1
+                state.delta = item
+            else:
+                # 新的关键帧之后，旧的差分帧没有用了
+                self.stats['skipped'] += (state.keyframe is not None) + (state.delta is not None)
+                state.keyframe = item
+                state.delta = None
+            self.schedule(sender_id, state)
+
+    def request(self, sender_id, tier, seed=None):
+        """新加入的接收端：返回缓存的 (header, prefix, jpeg)，没有时安排转码并返回 None
+
+        seed 是 (header, body, media)，用于转码器还没有这个发送端的画面时（例如服务器缓存的关键帧）
+        """
+        with self.lock:
+            state = self.senders.get(sender_id)
+            if state is not None and state.source is not None:
+                seq, renditions = self.cache.get(sender_id, (None, {}))
+                if seq == state.source[0].seq and tier in renditions:
+                    header, prefix, _ = state.source
+                    return header, prefix, renditions[tier]
+                state.render.add(tier)
+                self.schedule(sender_id, state)
+                return None
+
+        if seed is not None:
+            self.submit(sender_id, *seed, tiers={tier}, arrived=time.monotonic())
+        return None
+
+    def schedule(self, sender_id, state):
+        # 同一发送端同时只有一个任务在处理，保证帧的顺序
+        if state.running:
+            return
+        state.running = True
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pool.submit(self.process, sender_id, state)
+
+    def process(self, sender_id, state):
+        """处理线程：依次处理待处理的帧，直到没有新的帧"""
+        while True:
+            with self.lock:
+                keyframe, delta, render = state.keyframe, state.delta, state.render
+                state.keyframe = state.delta = None
+                state.render = set()
+                if keyframe is None and delta is None and not render:
+                    state.running = False
+                    return
+
+            try:
+                self.transcode(sender_id, state, keyframe, delta, render)
+            except Exception as e:
+                print(f"❌ 转码失败 ({sender_id}): {e}")
+
+    def transcode(self, sender_id, state, keyframe, delta, render):
+        items = [item for item in (keyframe, delta) if item is not None]
+        tiers = set(render)
+        for item in items:
+            tiers |= item[3]
+        if not tiers:
+            return
+        largest = max(TIERS[tier] for tier in tiers)
+
+        for item in items:
+            header, prefix, media, _, arrived = item
+            if item is keyframe:
+                # 按需要的最大档位解码，之后的差分帧也按这个比例贴
+                state.image = state.compositor.decode(media, (largest, largest))
+                state.original = state.key_media = media
+                state.delta_media = None
+            else:
+                state.image = state.compositor.decode(media)
+                state.original = None
+                state.delta_media = media
+            state.source = (header, prefix, arrived)
+            self.stats['frames'] += 1
+
+        if state.image is None:
+            # 还没有关键帧
+            return
+
+        compositor = state.compositor
+        if max(compositor.keyframe.size) < min(largest, max(compositor.full_size)):
+            # 关键帧是按较小的档位解码的，重新解码后再贴上最近的差分帧
+            compositor.decode(state.key_media, (largest, largest))
+            if state.delta_media is not None:
+                state.image = compositor.decode(state.delta_media)
+            else:
+                state.image = compositor.keyframe
+            self.stats['redecoded'] += 1
+
+        header, prefix, arrived = state.source
+        with self.lock:
+            seq, renditions = self.cache.get(sender_id, (None, {}))
+            if seq != header.seq:
+                renditions = {}
+                self.cache[sender_id] = (header.seq, renditions)
+
+        for tier in tiers:
+            if tier in renditions:
+                continue
+            jpeg = self.render_tier(state, tier)
+            renditions[tier] = jpeg
+            self.done.append((sender_id, tier, header, prefix, jpeg, arrived))
+
+        try:
+            self.notify_socket.send(b'\0')
+        except (BlockingIOError, OSError):
+            # 缓冲区满说明事件循环已经有待处理的通知
+            pass
+
+    def render_tier(self, state, tier):
+        image = state.image
+        size = fit(state.compositor.full_size, TIERS[tier])
+        if state.original is not None and size == state.compositor.full_size:
+            # 原始关键帧本来就不大于这个档位，直接用原来的 JPEG
+            self.stats['reused'] += 1
+            return bytes(state.original)
+
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.BILINEAR)
+        self.stats['renditions'] += 1
+        return encode_jpeg(image, TIER_QUALITY[tier])
+
+    def collect(self):
+        """事件循环：wake_socket 可读时取出所有转码结果"""
+        try:
+            while self.wake_socket.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        results = []
+        while self.done:
+            results.append(self.done.popleft())
+        return results
+
+    def discard(self, sender_id):
+        """发送端断开"""
+        with self.lock:
+            self.senders.pop(sender_id, None)
+            self.cache.pop(sender_id, None)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        self.wake_socket.close()
+        self.notify_socket.close()